@@ -0,0 +1,260 @@
+import os
+import time
+import json
+import queue
+import argparse
+import threading
+import http.server
+import concurrent.futures
+import numpy
+import cv2
+import torch
+import cyberset_preprocessor
+
+MODEL_FILE = './models_pt/resnet_full_aware_i8.pt'
+CLASSES_FILE = './classes.txt'
+IMAGE_SIZE = 224
+MAX_BATCH = 16
+LATENCY_BUDGET = 0.010
+THREADS = os.cpu_count()
+BACKEND_ENGINE = 'qnnpack'
+PORT = 8000
+IMAGENET_MEAN = numpy.array([0.485, 0.456, 0.406], dtype=numpy.float32)
+IMAGENET_STD = numpy.array([0.229, 0.224, 0.225], dtype=numpy.float32)
+
+def load_classes(classes_file=CLASSES_FILE):
+    with open(classes_file, 'r', encoding='utf-8', errors='replace') as f:
+        return [x.split('\t') for x in f.read().splitlines() if x != '']
+
+def load_model(model_file=MODEL_FILE, threads=THREADS, backend=BACKEND_ENGINE):
+    torch.set_num_threads(threads)
+    torch.backends.quantized.engine = backend
+    module = torch.jit.mobile._load_for_lite_interpreter(model_file) if model_file.endswith('.ptl') else torch.jit.load(model_file, map_location='cpu')
+    if hasattr(module, 'eval'):
+        module.eval()
+    def model(batch):
+        with torch.inference_mode():
+            return torch.softmax(module(torch.from_numpy(batch)), 1).numpy()
+    return model
+
+def prepare_picture(picture, image_size=IMAGE_SIZE):
+    if isinstance(picture, str):
+        image = cv2.imread(picture, cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imdecode(numpy.frombuffer(picture, numpy.uint8), cv2.IMREAD_COLOR) if len(picture) > 0 else None
+    if image is None:
+        raise ValueError('cannot decode picture')
+    return cv2.cvtColor(cyberset_preprocessor.pad_scale(image, image_size, cyberset_preprocessor.PADDING_VALUE), cv2.COLOR_BGR2RGB)
+
+class InferenceServer:
+    def __init__(self, model, classes, image_size=IMAGE_SIZE, max_batch=MAX_BATCH, latency_budget=LATENCY_BUDGET):
+        self.model = model
+        self.classes = classes
+        self.image_size = image_size
+        self.max_batch = max_batch
+        self.latency_budget = latency_budget
+        self.inputs = numpy.zeros((max_batch, 3, image_size, image_size), dtype=numpy.float32)
+        self.scale = (1 / (255 * IMAGENET_STD)).reshape(3, 1, 1)
+        self.shift = (IMAGENET_MEAN / IMAGENET_STD).reshape(3, 1, 1)
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.running = True
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies = list()
+            self.batches = list()
+            self.started = time.time()
+
+    def submit(self, picture):
+        future = concurrent.futures.Future()
+        try:
+            image = prepare_picture(picture, self.image_size)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        self.requests.put((time.time(), image, future))
+        return future
+
+    def predict(self, picture):
+        return self.submit(picture).result()
+
+    def collect(self):
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return []
+        deadline = batch[0][0] + self.latency_budget
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            batch.append(request)
+        return batch
+
+    def serve(self):
+        while self.running:
+            batch = self.collect()
+            if len(batch) == 0:
+                continue
+            inputs = self.inputs[0:len(batch)]
+            for i, (_, image, _) in enumerate(batch):
+                numpy.multiply(image.transpose(2, 0, 1), self.scale, out=inputs[i])
+                numpy.subtract(inputs[i], self.shift, out=inputs[i])
+            try:
+                probabilities = self.model(inputs)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.time()
+            for (arrival, _, future), scores in zip(batch, probabilities):
+                top = numpy.argsort(-scores)[0:2]
+                future.set_result([(self.classes[x], float(scores[x])) for x in top])
+            with self.lock:
+                self.latencies += [finished - x[0] for x in batch]
+                self.batches.append(len(batch))
+
+    def stats(self):
+        with self.lock:
+            latencies = numpy.array(self.latencies)
+            elapsed = time.time() - self.started
+            if len(latencies) == 0:
+                return {'requests': 0}
+            return {'requests': len(latencies), 'batches': len(self.batches), 'mean_batch': float(numpy.mean(self.batches)),
+                    'p50': float(numpy.percentile(latencies, 50)), 'p99': float(numpy.percentile(latencies, 99)), 'throughput': len(latencies) / elapsed}
+
+    def report(self, name='SERVER'):
+        stats = self.stats()
+        if stats['requests'] > 0:
+            print('{} requests={} batches={} mean_batch={:.1f} p50={:.1f}ms p99={:.1f}ms throughput={:.1f} images/s'.format(
+                name, stats['requests'], stats['batches'], stats['mean_batch'], stats['p50'] * 1000, stats['p99'] * 1000, stats['throughput']))
+        return stats
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)
+        self.worker.join()
+
+class PredictionHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, payload):
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.server.inference.stats())
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/predict':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            guesses = self.server.inference.predict(content)
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+            return
+        self.reply(200, [{'code': c[0], 'title': c[1] if len(c) > 1 else '', 'author': c[2] if len(c) > 2 else '', 'confidence': p} for c, p in guesses])
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_http(inference, port=PORT):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), PredictionHandler)
+    server.daemon_threads = True
+    server.inference = inference
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def list_pictures(directory):
+    return [('{}/{}/{}'.format(directory, b, x), b) for b in sorted(os.listdir(directory)) if os.path.isdir('{}/{}'.format(directory, b))
+            for x in sorted(os.listdir('{}/{}'.format(directory, b))) if x != 'card.txt']
+
+def score_directory(inference, directory, clients=32, verbose=True):
+    pictures = list_pictures(directory)
+    inference.reset_stats()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(lambda x: inference.submit(x[0]), pictures))
+    right = 0
+    wrong = list()
+    for (path, book), future in zip(pictures, results):
+        guesses = future.result() if future.exception() is None else None
+        if guesses is not None and guesses[0][0][0][4:] in book:
+            right += 1
+        else:
+            wrong.append((path, guesses[0][0][0] if guesses is not None else None))
+    if verbose:
+        for path, guess in wrong:
+            print('MISMATCH {} -> {}'.format(path, guess))
+        print('SCORE {} correct={}/{} accuracy={:.1f}%'.format(directory, right, len(pictures), right / max(len(pictures), 1) * 100))
+    inference.report('SCORE')
+    return right, wrong
+
+def benchmark_server(model, classes, directory, batches=(1, 4, 16), latency_budget=LATENCY_BUDGET, clients=32, repeat=2):
+    pictures = [x[0] for x in list_pictures(directory)] * repeat
+    results = dict()
+    for b in batches:
+        inference = InferenceServer(model, classes, max_batch=b, latency_budget=latency_budget if b > 1 else 0)
+        inference.predict(pictures[0])
+        inference.reset_stats()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+            for future in list(executor.map(inference.submit, pictures)):
+                future.exception()
+        results[b] = inference.report('BENCHMARK max_batch={} budget={:.0f}ms'.format(b, latency_budget * 1000 if b > 1 else 0))
+        inference.close()
+    return results
+
+# inference = InferenceServer(load_model('./models_pt/resnet_full_aware_i8.pt', threads=4, backend='qnnpack'), load_classes('./classes.txt'))
+# inference.predict('./photo.jpg')
+# score_directory(inference, './nilfdb')
+# server = serve_http(inference, port=8000)
+# benchmark_server(load_model(), load_classes(), './fairset_good_224/test', batches=(1, 4, 16))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched CPU inference server for the quantized TorchScript export.')
+    parser.add_argument('--model', default=MODEL_FILE)
+    parser.add_argument('--classes', default=CLASSES_FILE)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--backend', default=BACKEND_ENGINE, choices=('qnnpack', 'fbgemm'))
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--budget', type=float, default=LATENCY_BUDGET * 1000, help='batching latency budget in milliseconds')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--score', metavar='DIRECTORY', help='score every picture of a dataset directory and exit')
+    parser.add_argument('--benchmark', metavar='DIRECTORY', help='compare batch sizes on a dataset directory and exit')
+    arguments = parser.parse_args()
+    model = load_model(arguments.model, arguments.threads, arguments.backend)
+    classes = load_classes(arguments.classes)
+    if arguments.benchmark is not None:
+        benchmark_server(model, classes, arguments.benchmark, latency_budget=arguments.budget / 1000)
+    else:
+        inference = InferenceServer(model, classes, max_batch=arguments.max_batch, latency_budget=arguments.budget / 1000)
+        if arguments.score is not None:
+            score_directory(inference, arguments.score)
+        else:
+            server = serve_http(inference, arguments.port)
+            print('SERVING http://127.0.0.1:{}/predict'.format(arguments.port))
+            try:
+                while True:
+                    time.sleep(60)
+                    inference.report()
+            except KeyboardInterrupt:
+                server.shutdown()
+                inference.close()
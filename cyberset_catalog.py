@@ -0,0 +1,67 @@
+import os
+
+CATALOG_COLUMNS = ('book', 'title', 'author', 'codes', 'pictures', 'cover', 'files', 'directory_mtime', 'card_mtime')
+
+def index_file_name(directory_name):
+    return '{}.catalog.npz'.format(os.path.normpath(directory_name))
+
+def load_catalog(index_file):
+    import numpy
+    if not os.path.exists(index_file):
+        return dict()
+    with numpy.load(index_file, allow_pickle=False) as data:
+        columns = [data[x].tolist() for x in CATALOG_COLUMNS]
+    return {x[0]: x for x in zip(*columns)}
+
+def save_catalog(index_file, rows):
+    import numpy
+    columns = list(zip(*rows)) if len(rows) > 0 else [[] for x in CATALOG_COLUMNS]
+    arrays = dict()
+    for name, values in zip(CATALOG_COLUMNS, columns):
+        arrays[name] = numpy.array(values, dtype=numpy.int64) if name in ('pictures', 'directory_mtime', 'card_mtime') else numpy.array(values, dtype=str)
+    with open(index_file + '.tmp', 'wb') as f:
+        numpy.savez_compressed(f, **arrays)
+    os.replace(index_file + '.tmp', index_file)
+
+def scan_book(path, book, directory_mtime, card_mtime):
+    files = sorted(x.name for x in os.scandir(path) if x.is_file())
+    lines = list()
+    if 'card.txt' in files:
+        with open('{}/card.txt'.format(path), 'r') as f:
+            lines = f.read().splitlines()
+    lines += ['' for x in range(2 - len(lines))]
+    pictures = [x for x in files if x != 'card.txt']
+    covers = [x for x in pictures if 'cover' in x]
+    return (book, lines[0], lines[1], '\n'.join(lines[2:]), len(pictures), covers[0] if len(covers) > 0 else '', '\n'.join(files), directory_mtime, card_mtime)
+
+def catalog_columns(directory_name, index_file=None, verbose=False):
+    index_file = index_file_name(directory_name) if index_file is None else index_file
+    previous = load_catalog(index_file)
+    rows = list()
+    rescanned = 0
+    for entry in os.scandir(directory_name):
+        if not entry.is_dir():
+            continue
+        directory_mtime = entry.stat().st_mtime_ns
+        try:
+            card_mtime = os.stat('{}/card.txt'.format(entry.path)).st_mtime_ns
+        except FileNotFoundError:
+            card_mtime = 0
+        row = previous.get(entry.name)
+        if row is None or row[7] != directory_mtime or row[8] != card_mtime:
+            row = scan_book(entry.path, entry.name, directory_mtime, card_mtime)
+            rescanned += 1
+        rows.append(row)
+    rows.sort()
+    if rescanned > 0 or len(rows) != len(previous):
+        save_catalog(index_file, rows)
+    if verbose:
+        print('CATALOG {} books={} rescanned={}'.format(directory_name, len(rows), rescanned))
+    columns = dict(zip(CATALOG_COLUMNS, zip(*rows))) if len(rows) > 0 else {x: () for x in CATALOG_COLUMNS}
+    for column in ('codes', 'files'):
+        columns[column] = [x.split('\n') if x != '' else [] for x in columns[column]]
+    return {x: list(columns[x]) for x in CATALOG_COLUMNS}
+
+def catalog_index(directory_name, index_file=None, verbose=False):
+    import pandas
+    return pandas.DataFrame(catalog_columns(directory_name, index_file, verbose), columns=CATALOG_COLUMNS)
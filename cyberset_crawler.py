@@ -1,36 +1,240 @@
 import random
 import time
-import re
 import os
+import io
 import shutil
-import pandas
-import mechanicalsoup
+import json
+import sqlite3
+import hashlib
+import threading
+import itertools
+import contextlib
+import tempfile
+import urllib.parse
+import argparse
+import concurrent.futures
+import cyberset_catalog
+import cyberset_metrics
+import cyberset_records
 
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:93.0) Gecko/20100101 Firefox/93.0'
 SLEEP_INTERVAL = (100, 500)
-BROWSER = mechanicalsoup.StatefulBrowser(user_agent=USER_AGENT)
-CHECKPOINT_FILE = './checkpoint.txt'
+HOST_INTERVALS = {'www.fantascienza.com': (100, 500), 'www.ebay.it': (100, 500), 'www.comprovendolibri.it': (100, 500)}
+HOST_CONCURRENCY = 2
+WORKERS = 8
+JOURNAL_FILE = './journal.sqlite'
+RETRIES = 3
+RETRY_BACKOFF = 2.0
+CACHE_DIRECTORY = './http_cache'
+CACHE_MODE = 'on'
+CACHE_MAX_AGE = 30 * 24 * 3600
+CACHE_LIMIT = 2 * 1024 ** 3
+CACHE_LOCK = threading.Lock()
+CACHE_USAGE = [None]
+IMAGE_MAX_SIZE = 512
+IMAGE_MIN_SIZE = 64
+IMAGE_QUALITY = 90
+IMAGE_CHUNK = 64 * 1024
+LOCAL_STATE = threading.local()
+HOSTS_LOCK = threading.Lock()
+HOST_SLOTS = dict()
+HOST_TURNS = dict()
+
+def get_browser():
+    if not hasattr(LOCAL_STATE, 'browser'):
+        import mechanicalsoup
+        LOCAL_STATE.browser = mechanicalsoup.StatefulBrowser(user_agent=USER_AGENT)
+    return LOCAL_STATE.browser
+
+def wait_turn(address):
+    host = urllib.parse.urlsplit(address).netloc
+    with HOSTS_LOCK:
+        if host not in HOST_SLOTS:
+            HOST_SLOTS[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        slot = HOST_SLOTS[host]
+    with cyberset_metrics.timer('host_queue'):
+        slot.acquire()
+    with HOSTS_LOCK:
+        interval = HOST_INTERVALS.get(host, SLEEP_INTERVAL)
+        now = time.monotonic()
+        turn = max(now, HOST_TURNS.get(host, now))
+        HOST_TURNS[host] = turn + random.randint(interval[0], interval[1]) * 0.001
+    with cyberset_metrics.timer('host_sleep'):
+        time.sleep(turn - now)
+    return slot
+
+def cache_paths(address):
+    key = hashlib.sha1(address.encode('utf-8')).hexdigest()
+    return '{}/{}/{}.json'.format(CACHE_DIRECTORY, key[0:2], key), '{}/{}/{}.body'.format(CACHE_DIRECTORY, key[0:2], key)
+
+def cache_usage():
+    if CACHE_USAGE[0] is None:
+        CACHE_USAGE[0] = sum(e.stat().st_size for d in os.scandir(CACHE_DIRECTORY) if d.is_dir() for e in os.scandir(d.path)) if os.path.exists(CACHE_DIRECTORY) else 0
+    return CACHE_USAGE[0]
+
+def evict_cache():
+    entries = list()
+    for d in os.scandir(CACHE_DIRECTORY):
+        if d.is_dir():
+            entries += [(e.stat().st_mtime, e.path) for e in os.scandir(d.path) if e.name.endswith('.json')]
+    for _, meta_path in sorted(entries):
+        if CACHE_USAGE[0] <= CACHE_LIMIT * 0.9:
+            break
+        for path in (meta_path, meta_path[:-len('.json')] + '.body'):
+            if os.path.exists(path):
+                CACHE_USAGE[0] -= os.path.getsize(path)
+                os.remove(path)
+
+def cache_load(address):
+    meta_path, body_path = cache_paths(address)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        with open(body_path, 'rb') as f:
+            content = f.read()
+        os.utime(meta_path)
+    except (OSError, ValueError):
+        return None, None
+    return meta, content
+
+def cache_store(address, meta, content=None):
+    meta_path, body_path = cache_paths(address)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    with CACHE_LOCK:
+        cache_usage()
+    rewritten = (meta_path, body_path) if content is not None else (meta_path,)
+    previous = sum(os.path.getsize(x) for x in rewritten if os.path.exists(x))
+    suffix = '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+    if content is not None:
+        with open(body_path + suffix, 'wb') as f:
+            f.write(content)
+        os.replace(body_path + suffix, body_path)
+    with open(meta_path + suffix, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + suffix, meta_path)
+    with CACHE_LOCK:
+        CACHE_USAGE[0] += sum(os.path.getsize(x) for x in rewritten) - previous
+        if CACHE_USAGE[0] > CACHE_LIMIT:
+            evict_cache()
+
+def fetch(address):
+    meta, content = cache_load(address) if CACHE_MODE != 'off' else (None, None)
+    if meta is not None and (CACHE_MODE == 'offline' or time.time() - meta['stored'] < CACHE_MAX_AGE):
+        cyberset_metrics.count('cache_hit')
+        return meta['url'], '{} {} CACHED'.format(meta['status'], meta['reason']), content, meta['content_type']
+    if CACHE_MODE == 'offline':
+        raise LookupError('{} is not cached'.format(address))
+    headers = dict()
+    if meta is not None and meta['etag'] is not None:
+        headers['If-None-Match'] = meta['etag']
+    if meta is not None and meta['last_modified'] is not None:
+        headers['If-Modified-Since'] = meta['last_modified']
+    slot = wait_turn(address)
+    try:
+        with cyberset_metrics.timer('network'):
+            response = get_browser().session.get(address, headers=headers)
+    finally:
+        slot.release()
+    cyberset_metrics.count('network_bytes', len(response.content))
+    if response.status_code == 304 and meta is not None:
+        meta['stored'] = time.time()
+        cache_store(address, meta)
+        cyberset_metrics.count('cache_revalidated')
+        return meta['url'], '{} {} REVALIDATED'.format(meta['status'], meta['reason']), content, meta['content_type']
+    content_type = response.headers.get('Content-Type', '')
+    cyberset_metrics.count('cache_miss' if CACHE_MODE != 'off' else 'cache_off')
+    if response.status_code == 200 and CACHE_MODE != 'off':
+        meta = {'url': response.url, 'status': response.status_code, 'reason': response.reason, 'content_type': content_type, 'stored': time.time(),
+                'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        cache_store(address, meta, response.content)
+    return response.url, '{} {}'.format(response.status_code, response.reason), response.content, content_type
+
+def page_encoding(content_type):
+    return content_type.split('charset=')[-1].strip() if 'charset=' in content_type else None
 
 def get_page(address, verbose=True):
-    time.sleep(random.randint(SLEEP_INTERVAL[0], SLEEP_INTERVAL[1]) * 0.001)
-    page = BROWSER.get(address)
-    url = page.url
-    status = '{} {}'.format(page.status_code, page.reason)
-    soup = page.soup
+    import bs4
+    with cyberset_metrics.timer('get_page'):
+        url, status, content, content_type = fetch(address)
+        with cyberset_metrics.timer('parse_soup'):
+            soup = bs4.BeautifulSoup(content, from_encoding=page_encoding(content_type), **get_browser().soup_config)
     if verbose:
         print('GET {} {}'.format(url, status))
     return soup
 
+def get_record(kind, address, verbose=True):
+    import cyberset_parser
+    with cyberset_metrics.timer('get_record'):
+        url, status, content, content_type = fetch(address)
+        with cyberset_metrics.timer('parse_lxml'):
+            record = cyberset_parser.parse(kind, content, page_encoding(content_type))
+    if verbose:
+        print('GET {} {}'.format(url, status))
+    return record
+
 def get_image(address, verbose=True):
-    time.sleep(random.randint(SLEEP_INTERVAL[0], SLEEP_INTERVAL[1]) * 0.001)
-    image = BROWSER.open(address)
-    url = image.url
-    status = '{} {}'.format(image.status_code, image.reason)
-    content = image.content
+    with cyberset_metrics.timer('get_image'):
+        url, status, content, _ = fetch(address)
     if verbose:
         print('GET {} {}'.format(url, status))
     return content
 
+def stream_image(address, path):
+    if CACHE_MODE == 'offline':
+        raise LookupError('{} is not cached'.format(address))
+    slot = wait_turn(address)
+    try:
+        with cyberset_metrics.timer('network_stream'), get_browser().session.get(address, stream=True) as response:
+            if response.status_code == 200:
+                received = 0
+                with open(path, 'wb') as f:
+                    for chunk in response.iter_content(IMAGE_CHUNK):
+                        f.write(chunk)
+                        received += len(chunk)
+                cyberset_metrics.count('network_bytes', received)
+            return response.url, '{} {}'.format(response.status_code, response.reason), response.status_code == 200
+    finally:
+        slot.release()
+
+def normalize_picture(source, destination):
+    import cv2
+    with cyberset_metrics.timer('image_decode'):
+        image = cv2.imread(source, cv2.IMREAD_COLOR)
+    if image is None or min(image.shape[0:2]) < IMAGE_MIN_SIZE:
+        return False
+    factor = IMAGE_MAX_SIZE / max(image.shape[0:2])
+    if factor < 1:
+        with cyberset_metrics.timer('image_resize'):
+            image = cv2.resize(image, (round(image.shape[1] * factor), round(image.shape[0] * factor)), interpolation=cv2.INTER_AREA)
+    with cyberset_metrics.timer('imwrite'):
+        return cv2.imwrite(destination, image, [cv2.IMWRITE_JPEG_QUALITY, IMAGE_QUALITY])
+
+def download_picture(address, destination, verbose=True):
+    if os.path.exists(destination) or CACHE_MODE == 'offline':
+        kept = os.path.exists(destination)
+        cyberset_metrics.count('pictures_existing' if kept else 'pictures_offline')
+        if verbose:
+            print('SKIP {} {}'.format(address, 'EXISTING' if kept else 'OFFLINE'))
+        return kept
+    partial = '{}.{}.part'.format(destination, threading.get_ident())
+    try:
+        url, status, received = stream_image(address, partial)
+        kept = received and normalize_picture(partial, destination)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    cyberset_metrics.count('pictures_kept' if kept else 'pictures_dropped')
+    if verbose:
+        print('GET {} {}{}'.format(url, status, '' if kept else ' DROPPED'))
+    return kept
+
+def download_pictures(pictures, workers=WORKERS, verbose=True):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        kept = list(executor.map(lambda x: download_picture(x[0], x[1], verbose), pictures))
+    if verbose and len(pictures) > 0:
+        print('DOWNLOADED {} -> {}'.format(len(pictures), sum(kept)))
+    return kept
+
 def remove_duplicates_document(file_in, file_out, verbose=True):
     with open(file_in, 'r') as f:
         total = f.read().splitlines()
@@ -42,43 +246,39 @@ def remove_duplicates_document(file_in, file_out, verbose=True):
     if verbose:
         print('REDUCTION {} {} -> {} {}'.format(file_in, len(total), file_out, len(reduced)))
 
-def remove_duplicates_folder(directory_in, directory_out, verbose=True):
-    books = os.listdir(directory_in)
-    cards = list()
-    for b in books:
-        with open('{}/{}/card.txt'.format(directory_in, b), 'r') as f:
-            lines = f.read().splitlines()
-        card = (lines[0], lines[1], lines[2])
-        cards.append(card)
-    df = pandas.DataFrame(cards, columns=('title', 'author', 'code'))
-    classes = df.groupby(['title','author'])['code'].apply(list).reset_index().values.tolist()
-    for c in classes:
-        name = '-'.join(c[2])
+def remove_duplicates_folder(directory_in, directory_out, similarity=cyberset_records.RECORD_SIMILARITY, verbose=True):
+    catalog = cyberset_catalog.catalog_index(directory_in)
+    catalog['code'] = [x[0] if len(x) > 0 else '' for x in catalog['codes']]
+    titles = list(catalog['title'])
+    authors = list(catalog['author'])
+    if similarity is None:
+        groups = dict()
+        for k, key in enumerate(zip(titles, authors)):
+            groups.setdefault(key, list()).append(k)
+        groups = list(groups.values())
+    else:
+        groups = cyberset_records.group_near_records(titles, authors, similarity)
+    codes = list(catalog['code'])
+    classes = sorted(cyberset_records.canonical_record([titles[k] for k in x], [authors[k] for k in x], [codes[k] for k in x]) + (x,) for x in groups)
+    merged = 0
+    for title, author, members in classes:
+        group = catalog.iloc[members]
+        name = '-'.join(group['code'])
+        if len(set(zip(group['title'], group['author']))) > 1:
+            merged += 1
+            if verbose:
+                print('MERGED {} <- {}'.format(name, ' | '.join(sorted(set('{} ~ {}'.format(t, a) for t, a in zip(group['title'], group['author']))))))
         os.makedirs('{}/{}'.format(directory_out, name))
-        for n in c[2]:
-            cover = [x for x in os.listdir('{}/{}'.format(directory_in, n)) if 'cover' in x][0] if len([x for x in os.listdir('{}/{}'.format(directory_in, n)) if 'cover' in x]) > 0 else None
-            if cover != None:
-                shutil.copyfile('{}/{}/{}'.format(directory_in, n, cover), '{}/{}/{}'.format(directory_out, name, 'cover{}.{}'.format(n[4:], cover.split('.')[-1])))
+        for n, book, cover in zip(group['code'], group['book'], group['cover']):
+            if cover != '':
+                shutil.copyfile('{}/{}/{}'.format(directory_in, book, cover), '{}/{}/{}'.format(directory_out, name, 'cover{}.{}'.format(n[4:], cover.split('.')[-1])))
         with open('{}/{}/card.txt'.format(directory_out, name), 'w') as f:
-            f.write('{}\n'.format(c[0]))
-            f.write('{}\n'.format(c[1]))
-            for n in c[2]:
+            f.write('{}\n'.format(title))
+            f.write('{}\n'.format(author))
+            for n in group['code']:
                 f.write('{}\n'.format(n))
     if verbose:
-        print('REDUCTION {} {} -> {} {}'.format(directory_in, len(books), directory_out, len(classes)))
-
-def clean_record(string):
-    string = string.replace('\'', ' ')
-    string = string.replace('-', ' ')
-    string = string.replace('/', ' ')
-    string = string.replace('\r', ' ')
-    string = string.replace('\n', ' ')
-    string = string.replace('\t', ' ')
-    string = re.sub('\\(.*?\\)', '', string)
-    string = re.sub('[^a-zA-Z0-9àèéìòùÀÈÉÌÒÙ ]', '', string)
-    string = re.sub(' +', ' ', string)
-    string = string.lower().strip()
-    return string
+        print('REDUCTION {} {} -> {} {} fuzzy={}'.format(directory_in, len(catalog), directory_out, len(classes), merged))
 
 def remove_prefix(string, prefix):
     return string[len(prefix):] if string.startswith(prefix) else string
@@ -95,11 +295,7 @@ def shop_eb(keywords, path):
     pictures = [x['src'] for x in soup.select('.srp-results')[0].find_all('img') if x.has_attr('src') and x['src'].split('/')[-2] != 'pics'][0:count]
     if not os.path.exists(path):
         os.makedirs(path)
-    for p in pictures:
-        name = p.split('/')[-2]
-        extension = p.split('.')[-1]
-        with open('{}/{}.{}'.format(path, name, extension), 'wb') as f:
-            f.write(get_image(p))
+    download_pictures([(p, '{}/{}.jpg'.format(path, p.split('/')[-2])) for p in pictures])
 
 def shop_cvl(title, author, directory):
     search_title = title.strip().lower().replace(' ', '%20')
@@ -114,75 +310,188 @@ def shop_cvl(title, author, directory):
         pictures = [x for x in all_pictures if x.split('/')[-1] != 'noImg140.jpg' and x.split('/')[-2] != 'books.google.com']
         if len(all_pictures) == 0:
             break
-        for p in pictures:
-            name = p.split('/')[-1]
-            with open('{}/{}'.format(directory, name), 'wb') as f:
-                f.write(get_image(p))
+        download_pictures([(p, '{}/{}.jpg'.format(directory, os.path.splitext(p.split('/')[-1])[0])) for p in pictures])
         page += 1
 
-def call_catalog_scraper(name, addresses_list, document_name, folder_name, scraper):
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as c:
-            lines = c.read().splitlines()
-        if len(lines) > 0 and len(lines[0].split(' ')) >= 2 and lines[0].split(' ')[0] == name:
-            checkpoint = int(lines[0].split(' ')[1]) + 1
-        else:
-            checkpoint = 0
-    else:
-        checkpoint = 0
-    access = 'w' if checkpoint == 0 else 'a'
-    with open(document_name, access) as d:
-        for i in range(checkpoint, len(addresses_list)):
-            a = addresses_list[i]
-            print('SCRAPING {} {}/{}'.format(name, i+1, len(addresses_list)))
-            try:
-                scraper(a, d, folder_name)
-            except Exception as e:
-                print(e)
-            d.flush()
-            with open(CHECKPOINT_FILE, 'w') as c:
-                c.write('{} {} ({}/{})\n'.format(name, i, i+1, len(addresses_list)))
-    with open(CHECKPOINT_FILE, 'w') as c:
-        c.write('\n')
-
-def call_next_page(soup, function, document, folder):
-    following = 'https://www.fantascienza.com{}'.format(soup.select('.next')[0]['href']) if len(soup.select('.next')) != 0 else None
+def open_journal(journal_file):
+    journal = sqlite3.connect(journal_file, timeout=60)
+    journal.execute('PRAGMA journal_mode=WAL')
+    journal.execute('PRAGMA synchronous=NORMAL')
+    journal.execute("""CREATE TABLE IF NOT EXISTS jobs (stage TEXT, address TEXT, position INTEGER, status TEXT, attempts INTEGER,
+                    error TEXT, output TEXT, started REAL, finished REAL, PRIMARY KEY (stage, address))""")
+    journal.execute('CREATE TABLE IF NOT EXISTS frontier (stage TEXT, address TEXT, seq INTEGER, PRIMARY KEY (stage, address))')
+    if 'seq' not in [x[1] for x in journal.execute('PRAGMA table_info(frontier)')]:
+        with journal:
+            journal.execute('ALTER TABLE frontier ADD COLUMN seq INTEGER')
+            journal.execute('UPDATE frontier SET seq = n FROM (SELECT rowid AS r, ROW_NUMBER() OVER (PARTITION BY stage ORDER BY rowid) - 1 AS n FROM frontier) AS numbered WHERE frontier.rowid = numbered.r')
+    journal.execute('CREATE INDEX IF NOT EXISTS frontier_seq ON frontier (stage, seq)')
+    return journal
+
+def reset_stage(name, journal_file=JOURNAL_FILE):
+    with contextlib.closing(open_journal(journal_file)) as journal, journal:
+        journal.execute('DELETE FROM jobs WHERE stage = ?', (name,))
+        journal.execute('DELETE FROM frontier WHERE stage = ?', (name,))
+
+def journal_report(journal_file=JOURNAL_FILE):
+    with contextlib.closing(open_journal(journal_file)) as journal:
+        rows = journal.execute("""SELECT stage, SUM(status = 'done'), SUM(status = 'failed'), SUM(attempts), MIN(started), MAX(finished)
+                               FROM jobs GROUP BY stage ORDER BY MIN(started)""").fetchall()
+    for stage, done, failed, attempts, started, finished in rows:
+        elapsed = max(finished - started, 1e-9)
+        print('JOURNAL {} done={} failed={} attempts={} elapsed={:.1f}s rate={:.2f} addresses/s'.format(stage, done, failed, attempts, elapsed, (done + failed) / elapsed))
+    return rows
+
+def run_scraper(name, position, total, address, folder_name, scraper, attempts=0, retries=RETRIES, backoff=RETRY_BACKOFF):
+    started = time.time()
+    error = None
+    for attempt in range(retries):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        print('SCRAPING {} {}/{}{}'.format(name, position+1, total, ' RETRY {}'.format(attempt) if attempt > 0 else ''))
+        document = io.StringIO()
+        try:
+            with cyberset_metrics.timer(scraper.__name__):
+                scraper(address, document, folder_name)
+            return document.getvalue(), attempts + attempt + 1, None, started
+        except Exception as e:
+            print(e)
+            error = '{}: {}'.format(type(e).__name__, e)
+            cyberset_metrics.count('{}_errors'.format(scraper.__name__))
+    return '', attempts + retries, error, started
+
+def call_catalog_scraper(name, addresses_list, document_name, folder_name, scraper, workers=WORKERS, journal_file=JOURNAL_FILE, retries=RETRIES, backoff=RETRY_BACKOFF,
+                         metrics_file=None, profile=None):
+    cyberset_metrics.reset()
+    profiler = cyberset_metrics.start_profile(profile)
+    journal = open_journal(journal_file)
+    previous = dict(journal.execute('SELECT address, attempts FROM jobs WHERE stage = ? AND status = ?', (name, 'failed')))
+    completed = set(x for x, in journal.execute('SELECT address FROM jobs WHERE stage = ? AND status = ?', (name, 'done')))
+    access = 'w' if len(completed) == 0 else 'a'
+    pending = (i for i, x in enumerate(addresses_list) if x not in completed)
+    output = folder_name if folder_name is not None else document_name
+    start = time.time()
+    counts = {'done': 0, 'failed': 0}
+    def submit(i):
+        return executor.submit(run_scraper, name, i, len(addresses_list), addresses_list[i], folder_name, scraper, previous.get(addresses_list[i], 0), retries, backoff)
+    with open(document_name, access) as d, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = dict()
+        for i in itertools.islice(pending, workers * 2):
+            running[submit(i)] = i
+        while len(running) > 0:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                text, attempts, error, started = future.result()
+                d.write(text)
+                d.flush()
+                status = 'done' if error is None else 'failed'
+                counts[status] += 1
+                with journal:
+                    journal.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (name, addresses_list[i], i, status, attempts, error, output, started, time.time()))
+                for j in itertools.islice(pending, 1):
+                    running[submit(j)] = j
+    journal.close()
+    elapsed = time.time() - start
+    print('STAGE {} done={} failed={} skipped={} elapsed={:.1f}s rate={:.2f} addresses/s'.format(name, counts['done'], counts['failed'], len(completed), elapsed, (counts['done'] + counts['failed']) / max(elapsed, 1e-9)))
+    cyberset_metrics.report('STAGE {}'.format(name), '{}.metrics.json'.format(document_name) if metrics_file is None else metrics_file, profiler)
+
+def call_pipeline_scraper(stages, addresses_list, workers=WORKERS, journal_file=JOURNAL_FILE, retries=RETRIES, backoff=RETRY_BACKOFF, metrics_file=None, profile=None):
+    cyberset_metrics.reset()
+    profiler = cyberset_metrics.start_profile(profile)
+    journal = open_journal(journal_file)
+    names = [x[0] for x in stages]
+    sizes = [journal.execute('SELECT COUNT(*) FROM frontier WHERE stage = ?', (x,)).fetchone()[0] for x in names]
+    def add_frontier(k, addresses):
+        links = list()
+        with journal:
+            for x in addresses:
+                if journal.execute('INSERT OR IGNORE INTO frontier VALUES (?, ?, ?)', (names[k], x, sizes[k])).rowcount == 1:
+                    sizes[k] += 1
+                    links.append(x)
+        return links
+    add_frontier(0, addresses_list)
+    previous = dict(((x, y), z) for x, y, z in journal.execute('SELECT stage, address, attempts FROM jobs WHERE status = ?', ('failed',)) if x in names)
+    documents = list()
+    for name, document_name, folder_name, scraper in stages:
+        completed = journal.execute('SELECT COUNT(*) FROM jobs WHERE stage = ? AND status = ?', (name, 'done')).fetchone()[0]
+        documents.append(open(document_name, 'w' if completed == 0 else 'a'))
+    cursors = [-1 for x in stages]
+    counts = [{'done': 0, 'failed': 0} for x in stages]
+    start = time.time()
+    def refill():
+        for k in reversed(range(len(stages))):
+            rows = journal.execute("""SELECT seq, address FROM frontier f WHERE stage = ? AND seq > ? AND NOT EXISTS
+                                   (SELECT 1 FROM jobs j WHERE j.stage = f.stage AND j.address = f.address AND j.status = 'done')
+                                   ORDER BY seq LIMIT ?""", (names[k], cursors[k], workers * 2 - len(running))).fetchall()
+            for position, address in rows:
+                name, document_name, folder_name, scraper = stages[k]
+                future = executor.submit(run_scraper, name, position, sizes[k], address, folder_name, scraper, previous.get((name, address), 0), retries, backoff)
+                running[future] = (k, position, address)
+                cursors[k] = position
+            if len(running) >= workers * 2:
+                break
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = dict()
+        refill()
+        while len(running) > 0:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                k, position, address = running.pop(future)
+                text, attempts, error, started = future.result()
+                if k + 1 < len(stages):
+                    links = add_frontier(k + 1, [x for x in text.splitlines() if x != ''])
+                    text = ''.join('{}\n'.format(x) for x in links)
+                documents[k].write(text)
+                documents[k].flush()
+                status = 'done' if error is None else 'failed'
+                counts[k][status] += 1
+                output = stages[k][2] if stages[k][2] is not None else stages[k][1]
+                with journal:
+                    journal.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (names[k], address, position, status, attempts, error, output, started, time.time()))
+            refill()
+    for d in documents:
+        d.close()
+    journal.close()
+    elapsed = time.time() - start
+    for k, name in enumerate(names):
+        print('STAGE {} done={} failed={} frontier={} elapsed={:.1f}s rate={:.2f} addresses/s'.format(name, counts[k]['done'], counts[k]['failed'], sizes[k], elapsed, (counts[k]['done'] + counts[k]['failed']) / max(elapsed, 1e-9)))
+    cyberset_metrics.report('PIPELINE {}'.format('+'.join(names)), '{}.metrics.json'.format(stages[-1][1]) if metrics_file is None else metrics_file, profiler)
+
+def call_next_page(record, function, document, folder):
+    following = 'https://www.fantascienza.com{}'.format(record['next']) if record['next'] != None else None
     if following != None:
         function(following, document, folder)
 
 def scrape_letter(address, document, folder):
-    soup = get_page(address)
-    authors = soup.select('.elenco-autori')
-    links = ['https:{}'.format(x['href']) for inner in authors for x in inner.find_all('a')]
+    record = get_record('letter', address)
+    links = ['https:{}'.format(x) for x in record['links']]
     for l in links:
         if l != None:
             document.write('{}\n'.format(l))
-    call_next_page(soup, scrape_letter, document, folder)
+    call_next_page(record, scrape_letter, document, folder)
 
 def scrape_author(address, document, folder):
-    soup = get_page(address)
-    works = soup.select('#elenco-opere')[0].find_all('h4') if len(soup.select('#elenco-opere')) > 0 else []
-    links = ['https:{}'.format(x['href']) for inner in works for x in inner.find_all('a')]
+    record = get_record('author', address)
+    links = ['https:{}'.format(x) for x in record['links']]
     for l in links:
         if l != None:
             document.write('{}\n'.format(l))
-    call_next_page(soup, scrape_author, document, folder)
+    call_next_page(record, scrape_author, document, folder)
 
 def scrape_work(address, document, folder):
-    soup = get_page(address)
-    volumes = soup.select('.lista-edizioni')[0].find_all('h3')
-    links = ['https:{}'.format(x['href']) for inner in volumes for x in inner.find_all('a')]
+    record = get_record('work', address)
+    links = ['https:{}'.format(x) for x in record['links']]
     for l in links:
         if l != None:
             document.write('{}\n'.format(l))
-    call_next_page(soup, scrape_work, document, folder)
+    call_next_page(record, scrape_work, document, folder)
 
 def scrape_volume(address, document, folder):
-    soup = get_page(address)
-    title = clean_record(soup.find_all('h1')[0].get_text())
-    author = remove_prefix(clean_record(soup.select('.volume-autori')[0].get_text()), 'di ')
-    cover = 'https:{}'.format(soup.select('.copertina')[0]['src']) if 'https:{}'.format(soup.select('.copertina')[0]['src']).split('/')[-1] != 'nocover.png' else None
-    nilf = ['https:{}'.format(x['href']).split('/')[5] for x in soup.find_all('a') if x.get_text() == 'Permalink'][0]
+    record = get_record('volume', address)
+    title, author = cyberset_records.clean_records([record['title'], record['author']])
+    author = remove_prefix(author, 'di ')
+    cover = 'https:{}'.format(record['cover']) if record['cover'].split('/')[-1] != 'nocover.png' else None
+    nilf = 'https:{}'.format(record['permalink']).split('/')[5]
     path = '{}/{}'.format(folder, nilf)
     if not os.path.exists(path):
         os.makedirs(path)
@@ -192,9 +501,10 @@ def scrape_volume(address, document, folder):
             f.write('{}\n'.format(nilf))
         if cover != None:
             extension = cover.split('.')[-1]
-            with open('{}/cover.{}'.format(path, extension), 'wb') as f:
-                f.write(get_image(cover))
-    call_next_page(soup, scrape_volume, document, folder)
+            content = get_image(cover)
+            with cyberset_metrics.timer('disk_write'), open('{}/cover.{}'.format(path, extension), 'wb') as f:
+                f.write(content)
+    call_next_page(record, scrape_volume, document, folder)
 
 def scrape_shopping(address, document, folder):
     with open('{}/card.txt'.format(address), 'r') as f:
@@ -203,69 +513,158 @@ def scrape_shopping(address, document, folder):
     shop_eb(keywords, address)
 
 def manual_shop_again(start_from, less_than, directory_name):
-    books = os.listdir(directory_name)
-    for i, b in enumerate(books):
-        if i >= start_from - 1:
-            pictures = [x for x in os.listdir('{}/{}'.format(directory_name, b)) if x != 'card.txt']
-            if len(pictures) < less_than:
-                with open('{}/{}/card.txt'.format(directory_name, b), 'r') as f:
-                    lines = f.read().splitlines()
-                print('{}. {} {} by {} has {} pictures'.format(i+1, b, lines[0], lines[1], len(pictures)))
-                new_k = input('search eb keywords -> ')
-                if new_k != '':
-                    shop_eb(new_k, '{}/{}'.format(directory_name, b))
-                new_t = input('search cvl title -> ')
-                new_a = input('search cvl author -> ')
-                if new_t != '' or new_a != '':
-                    shop_cvl(new_t, new_a, '{}/{}'.format(directory_name, b))
+    catalog = cyberset_catalog.catalog_columns(directory_name)
+    for i, (b, title, author, pictures) in enumerate(zip(catalog['book'], catalog['title'], catalog['author'], catalog['pictures'])):
+        if i >= start_from - 1 and pictures < less_than:
+            print('{}. {} {} by {} has {} pictures'.format(i+1, b, title, author, pictures))
+            new_k = input('search eb keywords -> ')
+            if new_k != '':
+                shop_eb(new_k, '{}/{}'.format(directory_name, b))
+            new_t = input('search cvl title -> ')
+            new_a = input('search cvl author -> ')
+            if new_t != '' or new_a != '':
+                shop_cvl(new_t, new_a, '{}/{}'.format(directory_name, b))
+
+def remove_duplicate_pictures(directory_name, distance=None, verbose=True):
+    import cyberset_duplicates
+    distance = cyberset_duplicates.DUPLICATE_DISTANCE if distance is None else distance
+    catalog = cyberset_catalog.catalog_columns(directory_name)
+    paths = ['{}/{}/{}'.format(directory_name, b, x) for b, files in zip(catalog['book'], catalog['files']) for x in files if x != 'card.txt']
+    hashes = [cyberset_duplicates.dhash(x) for x in paths]
+    removed = 0
+    for group in cyberset_duplicates.group_near_duplicates(hashes, distance):
+        if len(group) < 2:
+            continue
+        books = dict()
+        for i in group:
+            books.setdefault(paths[i].split('/')[-2], list()).append(paths[i])
+        for b, pictures in books.items():
+            keep = sorted(pictures, key=lambda x: ('cover' not in x.split('/')[-1], -os.path.getsize(x), x))[0]
+            for p in pictures:
+                if p != keep:
+                    os.remove(p)
+                    removed += 1
+                    if verbose:
+                        print('DUPLICATE REMOVED {} ~ {}'.format(p, keep))
+        if len(books) > 1:
+            print('DUPLICATE ALERT {}'.format(' ~ '.join(sorted(books))))
+    if verbose:
+        print('REDUCTION {} {} -> {} {}'.format(directory_name, len(paths), directory_name, len(paths) - removed))
 
 def list_by_author(directory_name):
-    books = os.listdir(directory_name)
-    collection = list()
-    for b in books:
-        pictures = [x for x in os.listdir('{}/{}'.format(directory_name, b)) if x != 'card.txt']
-        with open('{}/{}/card.txt'.format(directory_name, b), 'r') as f:
-            lines = f.read().splitlines()
-        collection.append('{} ~ {} ~ {} ~ {}'.format(lines[1], lines[0], b, len(pictures)))
+    catalog = cyberset_catalog.catalog_columns(directory_name)
+    collection = ['{} ~ {} ~ {} ~ {}'.format(a, t, b, p) for a, t, b, p in zip(catalog['author'], catalog['title'], catalog['book'], catalog['pictures'])]
     for c in sorted(collection):
         print(c)
 
 def list_pictures_count(less_than, more_than, directory_name):
-    books = os.listdir(directory_name)
-    collection = list()
-    for b in books:
-        pictures = [x for x in os.listdir('{}/{}'.format(directory_name, b)) if x != 'card.txt']
-        if len(pictures) < less_than or len(pictures) > more_than:
-            with open('{}/{}/card.txt'.format(directory_name, b), 'r') as f:
-                lines = f.read().splitlines()
-            collection.append('{} ~ {} ~ {} ~ {}'.format(len(pictures), b, lines[0], lines[1]))
+    catalog = cyberset_catalog.catalog_columns(directory_name)
+    collection = ['{} ~ {} ~ {} ~ {}'.format(p, b, t, a) for p, b, t, a in zip(catalog['pictures'], catalog['book'], catalog['title'], catalog['author']) if p < less_than or p > more_than]
     for c in sorted(collection):
         print(c)
 
 def find_weird_records(folder_name, already_clean=False):
-    books = os.listdir(folder_name)
-    for directory_name in books:
+    catalog = cyberset_catalog.catalog_columns(folder_name)
+    for directory_name, codes, cover_name, samples in zip(catalog['book'], catalog['codes'], catalog['cover'], catalog['files']):
         if len(directory_name) != 10 or not 'NILF' in directory_name:
             print('DIRECTORY ALERT', directory_name)
-        samples = os.listdir('{}/{}'.format(folder_name, directory_name))
         for file_name in samples:
             if len(file_name.split('.')) < 2 or (file_name.split('.')[-1].lower() != 'jpg' and file_name != 'card.txt'):
                 print('EXTENSION ALERT', '{}/{}'.format(directory_name, file_name))
-            if 'cover' in file_name:
-                cover_name = file_name
-        if not already_clean and cover_name.split('.')[-2][5:] != directory_name[4:]:
-            print('COVER ALERT', directory_name)
-        if already_clean and cover_name != 'cover.jpg':
+        if cover_name == '' or (cover_name != 'cover.jpg' if already_clean else cover_name.split('.')[-2][5:] != directory_name[4:]):
             print('COVER ALERT', directory_name)
-        with open('{}/{}/card.txt'.format(folder_name, directory_name), 'r') as f:
-            lines = f.read().splitlines()
-        if len(lines) != 3:
+        if len(codes) != 1:
             print('CARD LINES ALERT', directory_name)
-        if lines[2] != directory_name:
+        if len(codes) == 0 or codes[0] != directory_name:
             print('CARD CODE ALERT', directory_name)
 
-def final_cleaning(source_directory, target_directory):
+def benchmark_fetcher(pages=120, hosts=3, latency=0.05, interval=(0, 0), workers_list=(1, 4, 16)):
+    import cyberset_fixture
+    servers = [cyberset_fixture.serve_fixture(latency=latency) for h in range(hosts)]
+    addresses = [cyberset_fixture.fixture_address(servers[i % hosts], '/catalogo/opere/{}/opera/'.format(cyberset_fixture.fixture_code(str(i)))) for i in range(pages)]
+    for s in servers:
+        HOST_INTERVALS['127.0.0.1:{}'.format(s.server_address[1])] = interval
+    global CACHE_MODE
+    cache_mode = CACHE_MODE
+    CACHE_MODE = 'off'
+    with tempfile.TemporaryDirectory() as directory:
+        for w in workers_list:
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                call_catalog_scraper('BENCHMARK', addresses, '{}/links.txt'.format(directory), None, scrape_work, workers=w, journal_file='{}/journal_{}.sqlite'.format(directory, w))
+            elapsed = time.time() - start
+            with open('{}/links.txt'.format(directory), 'r') as f:
+                links = len(f.read().splitlines())
+            print('BENCHMARK workers={} pages={} links={} elapsed={:.2f}s rate={:.1f} pages/s'.format(w, pages, links, elapsed, pages / elapsed))
+    CACHE_MODE = cache_mode
+    for s in servers:
+        s.shutdown()
+
+def benchmark_downloads(pictures=60, hosts=3, latency=0.05, interval=(0, 0), workers_list=(1, 4, 16)):
+    import cyberset_fixture
+    global CACHE_MODE
+    cache_mode = CACHE_MODE
+    CACHE_MODE = 'off'
+    servers = [cyberset_fixture.serve_fixture(latency=latency) for h in range(hosts)]
+    addresses = [cyberset_fixture.fixture_address(servers[i % hosts], '/images/{}.jpg'.format(cyberset_fixture.fixture_code(str(i)))) for i in range(pictures)]
+    for s in servers:
+        HOST_INTERVALS['127.0.0.1:{}'.format(s.server_address[1])] = interval
+    with tempfile.TemporaryDirectory() as directory:
+        for w in workers_list:
+            cyberset_metrics.reset()
+            start = time.time()
+            kept = download_pictures([(x, '{}/{}_{}.jpg'.format(directory, w, i)) for i, x in enumerate(addresses)], workers=w, verbose=False)
+            elapsed = time.time() - start
+            print('BENCHMARK workers={} pictures={} kept={} bytes={:.0f} elapsed={:.2f}s rate={:.1f} pictures/s'.format(
+                w, pictures, sum(kept), cyberset_metrics.snapshot()['counters'].get('network_bytes', 0), elapsed, pictures / elapsed))
+    CACHE_MODE = cache_mode
+    for s in servers:
+        s.shutdown()
+
+def soup_record(kind, content, encoding=None):
+    import bs4
+    soup = bs4.BeautifulSoup(content, from_encoding=encoding, **get_browser().soup_config)
+    if kind == 'volume':
+        record = {'title': soup.find_all('h1')[0].get_text(), 'author': soup.select('.volume-autori')[0].get_text(), 'cover': soup.select('.copertina')[0]['src'],
+                  'permalink': [x['href'] for x in soup.find_all('a') if x.get_text() == 'Permalink'][0]}
+    else:
+        containers = {'letter': soup.select('.elenco-autori'), 'author': soup.select('#elenco-opere')[0].find_all('h4') if len(soup.select('#elenco-opere')) > 0 else [],
+                      'work': soup.select('.lista-edizioni')[0].find_all('h3') if kind == 'work' else []}
+        record = {'links': [x['href'] for inner in containers[kind] for x in inner.find_all('a')]}
+    record['next'] = soup.select('.next')[0]['href'] if len(soup.select('.next')) != 0 else None
+    return record
+
+def benchmark_parser(directory=None, count=50, workers_list=(1, 2, 4)):
+    import cyberset_fixture
+    import cyberset_parser
+    with tempfile.TemporaryDirectory() as temporary:
+        if directory is None:
+            directory = temporary
+            cyberset_fixture.save_fixture_pages(directory, count)
+        pages = list()
+        for name in sorted(os.listdir(directory)):
+            with open('{}/{}'.format(directory, name), 'rb') as f:
+                pages.append((name.split('_')[0], f.read()))
+    start = time.time()
+    expected = [soup_record(kind, content) for kind, content in pages]
+    elapsed = time.time() - start
+    print('BENCHMARK parser=soup pages={} elapsed={:.2f}s rate={:.1f} pages/s'.format(len(pages), elapsed, len(pages) / elapsed))
+    parser_workers = cyberset_parser.PARSER_WORKERS
+    for w in workers_list:
+        cyberset_parser.PARSER_WORKERS = w
+        if w > 1:
+            cyberset_parser.get_parser_pool().submit(int).result()
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            records = list(executor.map(lambda x: cyberset_parser.parse(*x), pages))
+        elapsed = time.time() - start
+        print('BENCHMARK parser=lxml workers={} pages={} elapsed={:.2f}s rate={:.1f} pages/s matching={}'.format(w, len(pages), elapsed, len(pages) / elapsed, records == expected))
+    cyberset_parser.shutdown_parser_pool()
+    cyberset_parser.PARSER_WORKERS = parser_workers
+
+def final_cleaning(source_directory, target_directory, similarity=cyberset_records.RECORD_SIMILARITY):
     directories = os.listdir(source_directory)
+    cards = list()
     for d in directories:
         destination = '{}/{}'.format(target_directory, d)
         os.makedirs(destination)
@@ -279,14 +678,19 @@ def final_cleaning(source_directory, target_directory):
                 old_author = lines[1]
                 code = lines[2]
                 soup = get_page('http://nilf.it/{}'.format(code[4:]))
-                original_title = clean_record(soup.find_all('h1')[0].get_text())
-                original_author = remove_prefix(clean_record(soup.select('.volume-autori')[0].get_text()), 'di ')
-                if old_title.lower() != original_title:
-                    print('WARNING found title "{}" instead of "{}"'.format(original_title, old_title))
-                    input('->')
-                if old_author.lower() != original_author:
-                    print('WARNING found author "{}" instead of "{}"'.format(original_author, old_author))
-                    input('->')
+                original_title, original_author = cyberset_records.clean_records([soup.find_all('h1')[0].get_text(), soup.select('.volume-autori')[0].get_text()])
+                original_author = remove_prefix(original_author, 'di ')
+                if (old_title.lower(), old_author.lower()) != (original_title, original_author):
+                    if cyberset_records.similar_records([old_title, old_author], [original_title, original_author]):
+                        print('NOTICE found "{} ~ {}" instead of "{} ~ {}"'.format(original_title, original_author, old_title, old_author))
+                    else:
+                        if old_title.lower() != original_title:
+                            print('WARNING found title "{}" instead of "{}"'.format(original_title, old_title))
+                            input('->')
+                        if old_author.lower() != original_author:
+                            print('WARNING found author "{}" instead of "{}"'.format(original_author, old_author))
+                            input('->')
+                cards.append((code, original_title, original_author))
                 with open('{}/{}'.format(destination, f), 'w') as c:
                     c.write('{}\n'.format(original_title))
                     c.write('{}\n'.format(original_author))
@@ -312,48 +716,155 @@ def final_cleaning(source_directory, target_directory):
     print('SAMPLES IN SOURCE: {}'.format(s_count))
     print('SAMPLES IN DESTINATION: {}'.format(t_count))
     print('UNIQUE NAMES IN DESTINATION: {}'.format(len(t_samples)))
+    if similarity is not None:
+        codes, titles, authors = zip(*cards) if len(cards) > 0 else ((), (), ())
+        for group in cyberset_records.group_near_records(titles, authors, similarity):
+            if len(group) > 1:
+                print('DUPLICATE CLASSES {}'.format(' | '.join('{} {} ~ {}'.format(codes[k], titles[k], authors[k]) for k in sorted(group))))
+
+CATALOG_ADDRESS = 'https://www.fantascienza.com/catalogo/autori/{}/'
+BOOKS_DIRECTORY = './8_clean_books'
+CRAWL_STAGES = {'letter': ('LETTER', None, './1_raw_authors.txt', None, scrape_letter, './2_clean_authors.txt'),
+                'author': ('AUTHOR', './2_clean_authors.txt', './3_raw_works.txt', None, scrape_author, './4_clean_works.txt'),
+                'work': ('WORK', './4_clean_works.txt', './5_raw_volumes.txt', None, scrape_work, './6_clean_volumes.txt'),
+                'volume': ('VOLUME', './6_clean_volumes.txt', './dummy.txt', './7_raw_books', scrape_volume, BOOKS_DIRECTORY),
+                'shopping': ('SHOPPING', BOOKS_DIRECTORY, './dummy.txt', None, scrape_shopping, None)}
+
+def letter_addresses(letters):
+    letters = list(letters) if letters is not None else [chr(x) for x in range(ord('A'), ord('Z')+1)]
+    random.shuffle(letters)
+    return [CATALOG_ADDRESS.format(x) for x in letters]
+
+def stage_addresses(stage, source, letters=None):
+    if stage == 'letter':
+        return letter_addresses(letters)
+    if stage == 'shopping':
+        return ['{}/{}'.format(source, x) for x in sorted(os.listdir(source))]
+    with open(source, 'r') as f:
+        return f.read().splitlines()
+
+def crawl_stage(stage, arguments):
+    name, source, document, folder, scraper, clean = CRAWL_STAGES[stage]
+    source = arguments.input if arguments.input is not None else source
+    document = arguments.output if arguments.output is not None else document
+    folder = arguments.folder if arguments.folder is not None else folder
+    clean = arguments.clean if arguments.clean is not None else clean
+    call_catalog_scraper(name, stage_addresses(stage, source, arguments.letters), document, folder, scraper, workers=arguments.workers, journal_file=arguments.journal,
+                         retries=arguments.retries, backoff=arguments.backoff, metrics_file=arguments.metrics, profile=arguments.profile)
+    if stage == 'volume':
+        remove_duplicates_folder(folder, clean)
+    elif stage == 'shopping':
+        if arguments.remove_duplicate_pictures:
+            remove_duplicate_pictures(source, arguments.distance)
+    else:
+        remove_duplicates_document(document, clean)
+
+def crawl_pipeline(arguments):
+    stages = [('LETTER', './2_clean_authors.txt', None, scrape_letter), ('AUTHOR', './4_clean_works.txt', None, scrape_author),
+              ('WORK', './6_clean_volumes.txt', None, scrape_work), ('VOLUME', './dummy.txt', './7_raw_books', scrape_volume)]
+    call_pipeline_scraper(stages, letter_addresses(arguments.letters), workers=arguments.workers, journal_file=arguments.journal, retries=arguments.retries,
+                          backoff=arguments.backoff, metrics_file=arguments.metrics, profile=arguments.profile)
+    remove_duplicates_folder('./7_raw_books', BOOKS_DIRECTORY)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Crawl the fantascienza.com catalog and shop for cover pictures.')
+    parser.add_argument('--cache', default=CACHE_MODE, choices=('on', 'off', 'offline'), help='HTTP cache mode')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--journal', default=JOURNAL_FILE)
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    parser.add_argument('--backoff', type=float, default=RETRY_BACKOFF, help='retry backoff factor in seconds')
+    parser.add_argument('--metrics', help='metrics report file (default: next to the stage output)')
+    parser.add_argument('--profile', choices=('cprofile', 'sample'), help='profile the stage and add the hottest functions to the report')
+    commands = parser.add_subparsers(dest='command', required=True)
+    crawl = commands.add_parser('crawl', help='run one stage and deduplicate its output')
+    crawl.add_argument('stage', choices=tuple(CRAWL_STAGES))
+    crawl.add_argument('--letters', help='catalog letters for the letter stage, e.g. QUX (default: A-Z)')
+    crawl.add_argument('--input', help='addresses file, or the books directory for shopping')
+    crawl.add_argument('--output', help='raw output document')
+    crawl.add_argument('--folder', help='books folder for the volume stage')
+    crawl.add_argument('--clean', help='deduplicated output document or folder')
+    crawl.add_argument('--remove-duplicate-pictures', action='store_true', help='after shopping, delete near-duplicate pictures')
+    crawl.add_argument('--distance', type=int, help='near-duplicate distance for --remove-duplicate-pictures')
+    pipeline = commands.add_parser('pipeline', help='run letter, author, work and volume stages together')
+    pipeline.add_argument('--letters', help='catalog letters, e.g. QUX (default: A-Z)')
+    shop = commands.add_parser('shop', help='download pictures for a title and an author')
+    shop.add_argument('title')
+    shop.add_argument('author')
+    shop.add_argument('--folder', default='./sink')
+    shop_again = commands.add_parser('shop-again', help='interactively shop again for books with few pictures')
+    shop_again.add_argument('start_from', type=int)
+    shop_again.add_argument('less_than', type=int)
+    shop_again.add_argument('--directory', default=BOOKS_DIRECTORY)
+    duplicates = commands.add_parser('remove-duplicate-pictures', help='remove near-duplicate pictures')
+    duplicates.add_argument('--directory', default=BOOKS_DIRECTORY)
+    duplicates.add_argument('--distance', type=int)
+    catalog = commands.add_parser('catalog', help='refresh the catalog index')
+    catalog.add_argument('--directory', default=BOOKS_DIRECTORY)
+    by_author = commands.add_parser('list-by-author', help='list books sorted by author')
+    by_author.add_argument('--directory', default=BOOKS_DIRECTORY)
+    pictures_count = commands.add_parser('list-pictures-count', help='list books with too few or too many pictures')
+    pictures_count.add_argument('less_than', type=int)
+    pictures_count.add_argument('more_than', type=int)
+    pictures_count.add_argument('--directory', default=BOOKS_DIRECTORY)
+    weird = commands.add_parser('find-weird-records', help='check directory names, extensions, covers and cards')
+    weird.add_argument('--directory', default=BOOKS_DIRECTORY)
+    weird.add_argument('--already-clean', action='store_true')
+    cleaning = commands.add_parser('final-cleaning', help='check cards against the catalog and rename pictures')
+    cleaning.add_argument('source', nargs='?', default=BOOKS_DIRECTORY)
+    cleaning.add_argument('target', nargs='?', default='./9_final_books')
+    commands.add_parser('journal', help='print the crawl journal summary')
+    reset = commands.add_parser('reset-stage', help='forget the journal entries of a stage')
+    reset.add_argument('name')
+    fetcher = commands.add_parser('benchmark-fetcher', help='measure crawl throughput against local fixture servers')
+    fetcher.add_argument('--pages', type=int, default=120)
+    fetcher.add_argument('--hosts', type=int, default=3)
+    fetcher.add_argument('--latency', type=float, default=0.05)
+    downloads = commands.add_parser('benchmark-downloads', help='download and normalize fixture pictures through the shop path')
+    downloads.add_argument('--pictures', type=int, default=60)
+    downloads.add_argument('--hosts', type=int, default=3)
+    downloads.add_argument('--latency', type=float, default=0.05)
+    page_parser = commands.add_parser('benchmark-parser', help='compare the soup and lxml page parsers')
+    page_parser.add_argument('--count', type=int, default=50)
+    commands.add_parser('benchmark-imports', help='measure the import time of the dataset modules')
+    return parser
+
+def main(argv=None):
+    global CACHE_MODE
+    arguments = build_parser().parse_args(argv)
+    CACHE_MODE = arguments.cache
+    if arguments.command == 'crawl':
+        crawl_stage(arguments.stage, arguments)
+    elif arguments.command == 'pipeline':
+        crawl_pipeline(arguments)
+    elif arguments.command == 'shop':
+        shop_eb('{} {}'.format(arguments.title, arguments.author), arguments.folder)
+        shop_cvl(arguments.title, arguments.author, arguments.folder)
+    elif arguments.command == 'shop-again':
+        manual_shop_again(arguments.start_from, arguments.less_than, arguments.directory)
+    elif arguments.command == 'remove-duplicate-pictures':
+        remove_duplicate_pictures(arguments.directory, arguments.distance)
+    elif arguments.command == 'catalog':
+        cyberset_catalog.catalog_columns(arguments.directory, verbose=True)
+    elif arguments.command == 'list-by-author':
+        list_by_author(arguments.directory)
+    elif arguments.command == 'list-pictures-count':
+        list_pictures_count(arguments.less_than, arguments.more_than, arguments.directory)
+    elif arguments.command == 'find-weird-records':
+        find_weird_records(arguments.directory, arguments.already_clean)
+    elif arguments.command == 'final-cleaning':
+        final_cleaning(arguments.source, arguments.target)
+    elif arguments.command == 'journal':
+        journal_report(arguments.journal)
+    elif arguments.command == 'reset-stage':
+        reset_stage(arguments.name, arguments.journal)
+    elif arguments.command == 'benchmark-fetcher':
+        benchmark_fetcher(arguments.pages, arguments.hosts, arguments.latency)
+    elif arguments.command == 'benchmark-downloads':
+        benchmark_downloads(arguments.pictures, arguments.hosts, arguments.latency)
+    elif arguments.command == 'benchmark-parser':
+        benchmark_parser(count=arguments.count)
+    elif arguments.command == 'benchmark-imports':
+        cyberset_metrics.benchmark_imports(['cyberset_crawler', 'cyberset_preprocessor', 'cyberset_catalog', 'cyberset_records'])
 
-# letters = [chr(x) for x in range(ord('A'), ord('Z')+1)]
-# letters = ['Q', 'U', 'X']
-# random.shuffle(letters)
-# call_catalog_scraper('LETTER', ['https://www.fantascienza.com/catalogo/autori/{}/'.format(l) for l in letters], './1_raw_authors.txt', None, scrape_letter)
-# remove_duplicates_document('./1_raw_authors.txt', './2_clean_authors.txt')
-# input('SCRAPE LETTERS DONE -> ')
-
-# with open('./2_clean_authors.txt', 'r') as f:
-#    authors = f.read().splitlines()
-# authors = ['https://www.fantascienza.com/catalogo/autori/NILF10014/douglas-adams/']
-# call_catalog_scraper('AUTHOR', authors, './3_raw_works.txt', None, scrape_author)
-# remove_duplicates_document('./3_raw_works.txt', './4_clean_works.txt')
-# input('SCRAPE AUTHORS DONE -> ')
-
-# with open('./4_clean_works.txt', 'r') as f:
-#     works = f.read().splitlines()
-# call_catalog_scraper('WORK', works, './5_raw_volumes.txt', None, scrape_work)
-# remove_duplicates_document('./5_raw_volumes.txt', './6_clean_volumes.txt')
-# input('SCRAPE WORKS DONE -> ')
-
-# with open('./6_clean_volumes.txt', 'r') as f:
-#     volumes = f.read().splitlines()
-# call_catalog_scraper('VOLUME', volumes, './dummy.txt', './7_raw_books', scrape_volume)
-# remove_duplicates_folder('7_raw_books', '8_clean_books')
-# input('SCRAPE VOLUMES DONE -> ')
-
-# books = ['{}/{}'.format('./8_clean_books', x) for x in os.listdir('./8_clean_books')]
-# call_catalog_scraper('SHOPPING', books, './dummy.txt', None, scrape_shopping)
-# manual_shop_again(1, 4, './8_clean_books')
-# input('SCRAPE SHOPPING DONE -> ')
-
-# list_by_author('./8_clean_books')
-# list_pictures_count(4, 20, './8_clean_books')
-# find_weird_records('./8_clean_books')
-
-# title = 'innsmouth'
-# author = 'lovecraft'
-# folder = './sink'
-# shop_eb('{} {}'.format(title, author), folder)
-# shop_cvl(title, author, folder)
-
-# final_cleaning('./8_clean_books', './9_final_books')
-
-print('DONE')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import math
+import itertools
+import numpy
+import cv2
+import cyberset_records
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DUPLICATE_DISTANCE = 10
+MAX_CHUNK_BITS = 22
+POPCOUNT = numpy.array([bin(x).count('1') for x in range(256)], dtype=numpy.uint16)
+
+def dhash(path):
+    image = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None or min(image.shape) < HASH_SIZE + 1:
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    small_image = cv2.resize(image, (HASH_SIZE+1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small_image[:,1:] > small_image[:,:-1]
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+def hamming_distances(first, second):
+    difference = numpy.ascontiguousarray(numpy.bitwise_xor(first, second))
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(difference)
+    return POPCOUNT[difference.view(numpy.uint8).reshape(difference.shape + (8,))].sum(axis=-1)
+
+def chunk_radii(distance, chunks):
+    radius, extra = divmod(distance, chunks)
+    return [radius if c <= extra else radius - 1 for c in range(chunks)]
+
+def chunk_count(distance, size):
+    costs = dict()
+    fewest = math.ceil(HASH_BITS / MAX_CHUNK_BITS)
+    for chunks in range(fewest, max(distance + 2, fewest + 1)):
+        width = HASH_BITS // chunks
+        probes = sum(math.comb(width, k) for r in chunk_radii(distance, chunks) for k in range(r + 1))
+        costs[chunks] = probes * (1 + size / 2 ** width)
+    return min(costs, key=costs.get)
+
+def hash_members(hashes):
+    valid = [i for i, h in enumerate(hashes) if h is not None]
+    values, inverse = numpy.unique(numpy.array([hashes[i] for i in valid], dtype=numpy.uint64), return_inverse=True)
+    members = [list() for x in values]
+    for i, v in zip(valid, inverse.ravel()):
+        members[v].append(i)
+    return values, members
+
+def near_value_pairs(values, distance=DUPLICATE_DISTANCE):
+    chunks = chunk_count(distance, len(values))
+    bounds = [round(HASH_BITS * c / chunks) for c in range(chunks + 1)]
+    indices = numpy.arange(len(values))
+    found = [numpy.empty((0, 2), dtype=numpy.int64)]
+    for c, radius in enumerate(chunk_radii(distance, chunks)):
+        width = bounds[c+1] - bounds[c]
+        keys = ((values >> numpy.uint64(bounds[c])) & numpy.uint64((1 << width) - 1)).astype(numpy.int64)
+        order = numpy.argsort(keys, kind='stable')
+        sizes = numpy.bincount(keys, minlength=1 << width)
+        starts = numpy.cumsum(sizes) - sizes
+        for flips in range(radius + 1):
+            for bits in itertools.combinations(range(width), flips):
+                probes = keys ^ sum(1 << b for b in bits)
+                left = starts[probes]
+                counts = sizes[probes]
+                first = numpy.repeat(indices, counts)
+                second = order[numpy.repeat(left - numpy.cumsum(counts) + counts, counts) + numpy.arange(len(first))]
+                keep = first < second
+                first, second = first[keep], second[keep]
+                close = hamming_distances(values[first], values[second]) <= distance
+                found.append(numpy.stack([first[close], second[close]], axis=1))
+    return numpy.unique(numpy.concatenate(found), axis=0)
+
+def group_near_duplicates(hashes, distance=DUPLICATE_DISTANCE):
+    values, members = hash_members(hashes)
+    pairs = [(m[0], x) for m in members for x in m[1:]]
+    pairs += [(members[a][0], members[b][0]) for a, b in near_value_pairs(values, distance)]
+    return cyberset_records.union_groups(len(hashes), pairs)
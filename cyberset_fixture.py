@@ -0,0 +1,103 @@
+import random
+import struct
+import time
+import hashlib
+import threading
+import http.server
+
+FIXTURE_LINKS = 20
+FIXTURE_IMAGE_SIZE = (96, 128)
+
+def fixture_code(path):
+    return 'NILF{}'.format(random.Random(path).randint(100000, 999999))
+
+def fixture_image(generator, size=FIXTURE_IMAGE_SIZE):
+    width, height = size
+    stride = (width * 3 + 3) // 4 * 4
+    pixels = b''.join(generator.randbytes(width * 3) + bytes(stride - width * 3) for i in range(height))
+    header = struct.pack('<2sIHHIIiiHHIIiiII', b'BM', 54 + len(pixels), 0, 0, 54, 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + pixels
+
+def fixture_page(path):
+    generator = random.Random(path)
+    parts = [x for x in path.split('/') if x != '']
+    if len(parts) >= 2 and parts[0] == 'images':
+        return fixture_image(generator), 'image/bmp'
+    body = list()
+    if len(parts) == 3 and parts[1] == 'autori':
+        body.append('<h1>Autori {}</h1>'.format(parts[2]))
+        body.append('<div class="elenco-autori"><ul>')
+        for i in range(FIXTURE_LINKS):
+            body.append('<li><a href="//www.fantascienza.com/catalogo/autori/{}/autore-{}/">Autore {}</a></li>'.format(fixture_code('{}/{}'.format(path, i)), i, i))
+        body.append('</ul></div>')
+    elif len(parts) >= 3 and parts[1] == 'autori':
+        body.append('<h1>Autore {}</h1>'.format(parts[2]))
+        body.append('<div id="elenco-opere">')
+        for i in range(FIXTURE_LINKS):
+            body.append('<h4><a href="//www.fantascienza.com/catalogo/opere/{}/opera-{}/">Opera {}</a></h4><p>Romanzo, {}</p>'.format(fixture_code('{}/{}'.format(path, i)), i, i, 1950 + i))
+        body.append('</div>')
+    elif len(parts) >= 3 and parts[1] == 'opere':
+        body.append('<h1>Opera {}</h1>'.format(parts[2]))
+        body.append('<div class="lista-edizioni">')
+        for i in range(FIXTURE_LINKS):
+            body.append('<h3><a href="//www.fantascienza.com/catalogo/volumi/{}/volume-{}/">Volume {}</a></h3><p>Editore, {}</p>'.format(fixture_code('{}/{}'.format(path, i)), i, i, 1960 + i))
+        body.append('</div>')
+    elif len(parts) >= 3 and parts[1] == 'volumi':
+        body.append('<h1>Il volume {} (ristampa)</h1>'.format(generator.randint(1, 999)))
+        body.append('<div class="volume-autori">di Autore {}</div>'.format(generator.randint(1, 999)))
+        body.append('<img class="copertina" src="//{}/images/{}.jpg">'.format('www.fantascienza.com', parts[2]))
+        body.append('<ul>')
+        for i in range(FIXTURE_LINKS):
+            body.append('<li><a href="//www.fantascienza.com/catalogo/volumi/{}/">Altro {}</a></li>'.format(fixture_code('{}/{}'.format(path, i)), i))
+        body.append('</ul>')
+        body.append('<a href="//www.fantascienza.com/catalogo/volumi/{}/">Permalink</a>'.format(parts[2]))
+    else:
+        return None, None
+    page = '<html><head><title>Fixture</title></head><body><div id="menu">{}</div>{}</body></html>'.format(''.join('<a href="/{}">{}</a>'.format(x, x) for x in range(50)), ''.join(body))
+    return page.encode('utf-8'), 'text/html; charset=utf-8'
+
+def save_fixture_pages(directory, count=50):
+    paths = {'letter': '/catalogo/autori/{}/', 'author': '/catalogo/autori/{}/autore/', 'work': '/catalogo/opere/{}/opera/', 'volume': '/catalogo/volumi/{}/volume/'}
+    for kind, path in paths.items():
+        for i in range(count):
+            content, _ = fixture_page(path.format(fixture_code('{}/{}'.format(kind, i))))
+            with open('{}/{}_{}.html'.format(directory, kind, i), 'wb') as f:
+                f.write(content)
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        content, content_type = fixture_page(self.path.split('?')[0])
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_fixture(port=0, latency=0.05):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def fixture_address(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
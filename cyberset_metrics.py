@@ -0,0 +1,179 @@
+import os
+import sys
+import math
+import time
+import json
+import threading
+import contextlib
+import collections
+
+BUCKETS_PER_OCTAVE = 4
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 20
+HEAVY_MODULES = ('pandas', 'numpy', 'cv2', 'bs4', 'mechanicalsoup', 'requests', 'torch')
+METRICS_LOCK = threading.Lock()
+COUNTERS = collections.defaultdict(float)
+TIMERS = dict()
+
+def reset():
+    with METRICS_LOCK:
+        COUNTERS.clear()
+        TIMERS.clear()
+
+def count(name, value=1):
+    with METRICS_LOCK:
+        COUNTERS[name] += value
+
+def bucket(seconds):
+    return max(math.ceil(math.log2(max(seconds, 1e-7) * 1e6) * BUCKETS_PER_OCTAVE), 0)
+
+def record(name, seconds):
+    with METRICS_LOCK:
+        if name not in TIMERS:
+            TIMERS[name] = [0, 0.0, math.inf, 0.0, collections.Counter()]
+        timer = TIMERS[name]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = min(timer[2], seconds)
+        timer[3] = max(timer[3], seconds)
+        timer[4][bucket(seconds)] += 1
+
+@contextlib.contextmanager
+def timer(name):
+    since = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - since)
+
+def percentile(timer, fraction):
+    histogram = dict(timer['histogram'])
+    rank = fraction * timer['calls']
+    seen = 0
+    for b in sorted(histogram):
+        seen += histogram[b]
+        if seen >= rank:
+            return min(max(2 ** (b / BUCKETS_PER_OCTAVE) * 1e-6, timer['min']), timer['max'])
+    return timer['max']
+
+def snapshot():
+    with METRICS_LOCK:
+        return {'counters': dict(COUNTERS),
+                'timers': {x: {'calls': t[0], 'total': t[1], 'min': t[2], 'max': t[3], 'histogram': sorted(t[4].items())} for x, t in TIMERS.items()}}
+
+def merge(metrics):
+    with METRICS_LOCK:
+        for name, value in metrics['counters'].items():
+            COUNTERS[name] += value
+        for name, t in metrics['timers'].items():
+            if name not in TIMERS:
+                TIMERS[name] = [0, 0.0, math.inf, 0.0, collections.Counter()]
+            timer = TIMERS[name]
+            timer[0] += t['calls']
+            timer[1] += t['total']
+            timer[2] = min(timer[2], t['min'])
+            timer[3] = max(timer[3], t['max'])
+            timer[4].update(dict(t['histogram']))
+
+def collect(function, *arguments):
+    reset()
+    result = function(*arguments)
+    return result, snapshot()
+
+class Sampler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.inclusive = collections.Counter()
+        self.exclusive = collections.Counter()
+        self.running = True
+        self.worker = threading.Thread(target=self.sample, daemon=True)
+        self.worker.start()
+
+    def sample(self):
+        own = threading.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    key = '{}:{}:{}'.format(frame.f_code.co_filename.split('/')[-1], frame.f_code.co_firstlineno, frame.f_code.co_name)
+                    if leaf:
+                        self.exclusive[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        self.inclusive[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+
+    def stop(self, output=None, top=PROFILE_TOP):
+        self.running = False
+        self.worker.join()
+        return [{'function': x, 'exclusive': self.exclusive[x] * self.interval, 'inclusive': y * self.interval} for x, y in self.inclusive.most_common(top)]
+
+class Profiler:
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self, output=None, top=PROFILE_TOP):
+        import pstats
+        self.profile.disable()
+        if output is not None:
+            self.profile.dump_stats(output)
+        statistics = pstats.Stats(self.profile).stats
+        rows = sorted(statistics.items(), key=lambda x: -x[1][3])[0:top]
+        return [{'function': '{}:{}:{}'.format(f[0].split('/')[-1], f[1], f[2]), 'exclusive': s[2], 'inclusive': s[3]} for f, s in rows]
+
+def start_profile(mode):
+    if mode is None:
+        return None
+    if mode == 'cprofile':
+        return Profiler()
+    if mode == 'sample':
+        return Sampler()
+    raise ValueError('unknown profile mode {}'.format(mode))
+
+def report(name, output=None, profiler=None):
+    metrics = snapshot()
+    if profiler is not None:
+        metrics['profile'] = profiler.stop(output[:-len('.json')] + '.prof' if output is not None and output.endswith('.json') else None)
+    print('METRICS {}'.format(name))
+    print('{:<28} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format('timer', 'calls', 'total', 'mean', 'p50', 'p99', 'max'))
+    for timer_name, t in sorted(metrics['timers'].items(), key=lambda x: -x[1]['total']):
+        t['p50'] = percentile(t, 0.5)
+        t['p99'] = percentile(t, 0.99)
+        print('{:<28} {:>8} {:>9.2f}s {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms {:>7.2f}ms'.format(timer_name, t['calls'], t['total'], t['total'] / t['calls'] * 1000,
+                                                                                    t['p50'] * 1000, t['p99'] * 1000, t['max'] * 1000))
+    for counter_name, value in sorted(metrics['counters'].items()):
+        print('{:<28} {:>8g}'.format(counter_name, value))
+    for row in metrics.get('profile', []):
+        print('PROFILE {:<48} inclusive={:.2f}s exclusive={:.2f}s'.format(row['function'], row['inclusive'], row['exclusive']))
+    if output is not None:
+        with open(output + '.tmp', 'w') as f:
+            json.dump(dict(metrics, name=name, created=time.time()), f, indent=1)
+        os.replace(output + '.tmp', output)
+    return metrics
+
+def import_time(module, heavy=HEAVY_MODULES, repeat=3):
+    import subprocess
+    command = 'import sys, {}; print(" ".join(x for x in {} if x in sys.modules))'.format(module, repr(tuple(heavy)))
+    times = list()
+    for i in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', command], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(int(result.stderr.strip().splitlines()[-1].split('|')[1]) * 1e-6)
+    return min(times), result.stdout.split()
+
+def benchmark_imports(modules, heavy=HEAVY_MODULES, repeat=3):
+    results = dict()
+    for module in modules:
+        elapsed, loaded = import_time(module, heavy, repeat)
+        results[module] = {'time': elapsed, 'loaded': loaded}
+        print('IMPORT {} time={:.3f}s heavy={}'.format(module, elapsed, ','.join(loaded) if len(loaded) > 0 else '-'))
+    return results
@@ -0,0 +1,83 @@
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+import lxml.etree
+import lxml.html
+
+PARSER_WORKERS = max(min(os.cpu_count() // 2, 4), 1)
+PARSER_LOCK = threading.RLock()
+PARSER_POOL = [None]
+HTML_PARSERS = dict()
+
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+NEXT = lxml.etree.XPath('(//*[{}])[1]/@href'.format(has_class('next')))
+TEXT = lxml.etree.XPath('descendant::text()[not(parent::script or parent::style)]')
+AUTHOR_LINKS = lxml.etree.XPath('//*[{}]//a/@href'.format(has_class('elenco-autori')))
+WORKS = lxml.etree.XPath("(//*[@id='elenco-opere'])[1]")
+WORK_LINKS = lxml.etree.XPath('.//h4//a/@href')
+VOLUMES = lxml.etree.XPath('(//*[{}])[1]'.format(has_class('lista-edizioni')))
+VOLUME_LINKS = lxml.etree.XPath('.//h3//a/@href')
+TITLE = lxml.etree.XPath('(//h1)[1]')
+VOLUME_AUTHORS = lxml.etree.XPath('(//*[{}])[1]'.format(has_class('volume-autori')))
+COVER = lxml.etree.XPath('(//*[{}])[1]/@src'.format(has_class('copertina')))
+PERMALINK = lxml.etree.XPath("(//a[. = 'Permalink'])[1]/@href")
+
+def parse_document(content, encoding=None):
+    if encoding not in HTML_PARSERS:
+        HTML_PARSERS[encoding] = lxml.html.HTMLParser(encoding=encoding)
+    return lxml.html.document_fromstring(content, parser=HTML_PARSERS[encoding])
+
+def first(values, name):
+    if len(values) == 0:
+        raise ValueError('missing {} in page'.format(name))
+    return values[0]
+
+def element_text(element):
+    return ''.join(TEXT(element))
+
+def parse_letter(document):
+    return {'links': AUTHOR_LINKS(document)}
+
+def parse_author(document):
+    works = WORKS(document)
+    return {'links': WORK_LINKS(works[0]) if len(works) > 0 else []}
+
+def parse_work(document):
+    return {'links': VOLUME_LINKS(first(VOLUMES(document), '.lista-edizioni'))}
+
+def parse_volume(document):
+    return {'title': element_text(first(TITLE(document), 'h1')), 'author': element_text(first(VOLUME_AUTHORS(document), '.volume-autori')),
+            'cover': first(COVER(document), '.copertina'), 'permalink': first(PERMALINK(document), 'Permalink')}
+
+PAGE_PARSERS = {'letter': parse_letter, 'author': parse_author, 'work': parse_work, 'volume': parse_volume}
+
+def parse_page(kind, content, encoding=None):
+    document = parse_document(content, encoding)
+    record = PAGE_PARSERS[kind](document)
+    following = NEXT(document)
+    record['next'] = following[0] if len(following) > 0 else None
+    return record
+
+def get_parser_pool():
+    pool = PARSER_POOL[0]
+    if pool is None or pool[0] != PARSER_WORKERS:
+        with PARSER_LOCK:
+            if PARSER_POOL[0] is None or PARSER_POOL[0][0] != PARSER_WORKERS:
+                shutdown_parser_pool()
+                PARSER_POOL[0] = (PARSER_WORKERS, concurrent.futures.ProcessPoolExecutor(max_workers=PARSER_WORKERS, mp_context=multiprocessing.get_context('spawn')))
+            pool = PARSER_POOL[0]
+    return pool[1]
+
+def shutdown_parser_pool():
+    with PARSER_LOCK:
+        if PARSER_POOL[0] is not None:
+            PARSER_POOL[0][1].shutdown()
+            PARSER_POOL[0] = None
+
+def parse(kind, content, encoding=None):
+    if PARSER_WORKERS <= 1:
+        return parse_page(kind, content, encoding)
+    return get_parser_pool().submit(parse_page, kind, content, encoding).result()
@@ -2,10 +2,20 @@ import random
 import math
 import os
 import shutil
+import time
+import zlib
+import json
+import hashlib
+import argparse
+import concurrent.futures
 import numpy
 import cv2
+import cyberset_duplicates
+import cyberset_metrics
 
 SOURCE_DATASET = 'nilfdb'
+SPLITS = ('train', 'validation', 'test')
+WORKERS = os.cpu_count()
 CONTRAST_BOUNDS = (0.8, 1.3)
 BRIGHTNESS_BOUNDS = (-20, 20)
 BLUR_BOUNDS = (-1.3, 1.1)
@@ -16,24 +26,46 @@ TRANSLATION_BOUNDS = ((-30, 30), (-10, 10))
 ROTATION_BOUNDS = (-20, 20)
 SCALE_BOUNDS = (0.9, 1.1)
 SHEAR_BOUNDS = (-0.1, 0.1)
+AUGMENTATION_PARAMETERS = ('contrast', 'brightness', 'blur', 'noise', 'translation_x', 'translation_y', 'rotation', 'scale', 'shear', 'red', 'green', 'blue')
 
 def pad_scale(image, target_size, gray_value):
-    height = image.shape[0]
-    width = image.shape[1]
-    if height >= width:
-        target_height = target_size
-        target_width = round(width / height * target_height)
-        raw_padding = (target_height - target_width) / 2
-        padding = (0,0,math.ceil(raw_padding),math.floor(raw_padding))
-    else:
-        target_width = target_size
-        target_height = round(height / width * target_width)
-        raw_padding = (target_width - target_height) / 2
-        padding = (math.ceil(raw_padding),math.floor(raw_padding),0,0)
-    resized_image = cv2.resize(image, (target_width, target_height))
-    padded_image = cv2.copyMakeBorder(resized_image, padding[0], padding[1], padding[2], padding[3], cv2.BORDER_CONSTANT, value=(gray_value,gray_value,gray_value))
+    with cyberset_metrics.timer('pad_scale'):
+        height = image.shape[0]
+        width = image.shape[1]
+        if height >= width:
+            target_height = target_size
+            target_width = round(width / height * target_height)
+            raw_padding = (target_height - target_width) / 2
+            padding = (0,0,math.ceil(raw_padding),math.floor(raw_padding))
+        else:
+            target_width = target_size
+            target_height = round(height / width * target_width)
+            raw_padding = (target_width - target_height) / 2
+            padding = (math.ceil(raw_padding),math.floor(raw_padding),0,0)
+        resized_image = cv2.resize(image, (target_width, target_height))
+        padded_image = cv2.copyMakeBorder(resized_image, padding[0], padding[1], padding[2], padding[3], cv2.BORDER_CONSTANT, value=(gray_value,gray_value,gray_value))
     return padded_image
 
+def decode_picture(path, cache_directory=None):
+    if cache_directory is not None:
+        key = '{}|{}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns)
+        cached_path = '{}/{}.npy'.format(cache_directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        if os.path.exists(cached_path):
+            cyberset_metrics.count('decoded_cache_hit')
+            return numpy.load(cached_path, mmap_mode='r')
+    with cyberset_metrics.timer('decode'):
+        picture = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+    if cache_directory is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_path = '{}.{}.tmp'.format(cached_path, os.getpid())
+        with open(temporary_path, 'wb') as f:
+            numpy.save(f, picture)
+        os.replace(temporary_path, cached_path)
+    return picture
+
+def load_picture(path, target_size, cache_directory=None):
+    return pad_scale(decode_picture(path, cache_directory), target_size, PADDING_VALUE)
+
 def naive_correction(image, contrast, brightness):
     corrected_image = image.astype(numpy.int32) * contrast + brightness
     clipped_image = numpy.clip(corrected_image, 0, 255).astype(numpy.uint8)
@@ -50,9 +82,9 @@ def blur_sharpen(image, amount):
         enhanced_image = numpy.clip(sharpened_image, 0, 255).astype(numpy.uint8)
     return enhanced_image
 
-def add_gaussian_noise(image, variance):
+def add_gaussian_noise(image, variance, rng=None):
     mean = 0.0
-    noise = numpy.random.normal(mean, variance, image.shape)
+    noise = (numpy.random if rng is None else rng).normal(mean, variance, image.shape)
     noisy_image = image.astype(numpy.int32) + noise
     clipped_image = numpy.clip(noisy_image, 0, 255).astype(numpy.uint8)
     return clipped_image
@@ -71,27 +103,102 @@ def recolor(image, red, green, blue):
     clipped_image = numpy.clip(recolored_image, 0, 255).astype(numpy.uint8)
     return clipped_image
 
-def generate_augmentation(image, verbose=False):
+def random_integer(rng, bounds, factor=1):
+    return int(rng.integers(round(bounds[0]*factor), round(bounds[1]*factor), endpoint=True))
+
+def generate_augmentation(image, verbose=False, rng=None):
+    rng = numpy.random.default_rng() if rng is None else rng
     result_image = image.copy()
-    contrast = random.randint(round(CONTRAST_BOUNDS[0]*1000), round(CONTRAST_BOUNDS[1]*1000)) * 0.001
-    brightness = random.randint(*BRIGHTNESS_BOUNDS)
-    blur = random.randint(round(BLUR_BOUNDS[0]*1000), round(BLUR_BOUNDS[1]*1000)) * 0.001
+    contrast = random_integer(rng, CONTRAST_BOUNDS, 1000) * 0.001
+    brightness = random_integer(rng, BRIGHTNESS_BOUNDS)
+    blur = random_integer(rng, BLUR_BOUNDS, 1000) * 0.001
     noise = NOISE_VARIANCE
-    translation = (random.randint(*TRANSLATION_BOUNDS[0]),random.randint(*TRANSLATION_BOUNDS[1]))
-    rotation = random.randint(*ROTATION_BOUNDS)
-    scale = random.randint(round(SCALE_BOUNDS[0]*1000), round(SCALE_BOUNDS[1]*1000)) * 0.001
-    shear = random.randint(round(SHEAR_BOUNDS[0]*1000), round(SHEAR_BOUNDS[1]*1000)) * 0.001
-    color = (random.randint(*COLOR_BOUNDS), random.randint(*COLOR_BOUNDS), random.randint(*COLOR_BOUNDS))
+    translation = (random_integer(rng, TRANSLATION_BOUNDS[0]),random_integer(rng, TRANSLATION_BOUNDS[1]))
+    rotation = random_integer(rng, ROTATION_BOUNDS)
+    scale = random_integer(rng, SCALE_BOUNDS, 1000) * 0.001
+    shear = random_integer(rng, SHEAR_BOUNDS, 1000) * 0.001
+    color = (random_integer(rng, COLOR_BOUNDS), random_integer(rng, COLOR_BOUNDS), random_integer(rng, COLOR_BOUNDS))
     background = PADDING_VALUE
-    result_image = affine_transform(result_image, translation, rotation, scale, background, shear=shear)
-    result_image = recolor(result_image,*color)
-    result_image = add_gaussian_noise(result_image, noise)
-    result_image = naive_correction(result_image, contrast, brightness)
-    result_image = blur_sharpen(result_image, blur)
+    with cyberset_metrics.timer('augmentation_affine'):
+        result_image = affine_transform(result_image, translation, rotation, scale, background, shear=shear)
+    with cyberset_metrics.timer('augmentation_recolor'):
+        result_image = recolor(result_image,*color)
+    with cyberset_metrics.timer('augmentation_noise'):
+        result_image = add_gaussian_noise(result_image, noise, rng=rng)
+    with cyberset_metrics.timer('augmentation_correction'):
+        result_image = naive_correction(result_image, contrast, brightness)
+    with cyberset_metrics.timer('augmentation_blur'):
+        result_image = blur_sharpen(result_image, blur)
     if verbose:
         print('CONT:', contrast, 'BRIG:', brightness, 'BLUR:', blur, 'NOIS:', noise, 'TRAN', translation, 'ROTA', rotation, 'SCAL', scale, 'COLO', color, 'BACK', background)
     return result_image
 
+def sample_augmentations(count, rng):
+    parameters = numpy.empty((count, len(AUGMENTATION_PARAMETERS)), dtype=numpy.float64)
+    parameters[:,0] = rng.integers(round(CONTRAST_BOUNDS[0]*1000), round(CONTRAST_BOUNDS[1]*1000), count, endpoint=True) * 0.001
+    parameters[:,1] = rng.integers(BRIGHTNESS_BOUNDS[0], BRIGHTNESS_BOUNDS[1], count, endpoint=True)
+    parameters[:,2] = rng.integers(round(BLUR_BOUNDS[0]*1000), round(BLUR_BOUNDS[1]*1000), count, endpoint=True) * 0.001
+    parameters[:,3] = NOISE_VARIANCE
+    parameters[:,4] = rng.integers(TRANSLATION_BOUNDS[0][0], TRANSLATION_BOUNDS[0][1], count, endpoint=True)
+    parameters[:,5] = rng.integers(TRANSLATION_BOUNDS[1][0], TRANSLATION_BOUNDS[1][1], count, endpoint=True)
+    parameters[:,6] = rng.integers(ROTATION_BOUNDS[0], ROTATION_BOUNDS[1], count, endpoint=True)
+    parameters[:,7] = rng.integers(round(SCALE_BOUNDS[0]*1000), round(SCALE_BOUNDS[1]*1000), count, endpoint=True) * 0.001
+    parameters[:,8] = rng.integers(round(SHEAR_BOUNDS[0]*1000), round(SHEAR_BOUNDS[1]*1000), count, endpoint=True) * 0.001
+    parameters[:,9:12] = rng.integers(COLOR_BOUNDS[0], COLOR_BOUNDS[1], (count, 3), endpoint=True)
+    return parameters
+
+def affine_matrix(shape, translation, rotation, scale, shear):
+    center = (round(shape[1]/2), round(shape[0]/2))
+    rotation_matrix = numpy.vstack([cv2.getRotationMatrix2D(center, rotation, scale), (0,0,1)])
+    translation_matrix = numpy.array([[1,shear,translation[0]],[0,1,translation[1]],[0,0,1]])
+    return (translation_matrix @ rotation_matrix)[0:2]
+
+def augment_batch(images, rng=None):
+    rng = numpy.random.default_rng() if rng is None else rng
+    count = images.shape[0]
+    parameters = sample_augmentations(count, rng)
+    size = (images.shape[2], images.shape[1])
+    background = (PADDING_VALUE,PADDING_VALUE,PADDING_VALUE)
+    warped_images = numpy.empty_like(images)
+    with cyberset_metrics.timer('augmentation_affine'):
+        for k in range(count):
+            matrix = affine_matrix(images.shape[1:], parameters[k,4:6], float(parameters[k,6]), float(parameters[k,7]), float(parameters[k,8]))
+            cv2.warpAffine(images[k], matrix, size, dst=warped_images[k], borderMode=cv2.BORDER_CONSTANT, borderValue=background)
+    with cyberset_metrics.timer('augmentation_noise'):
+        corrected_images = rng.standard_normal(images.shape, dtype=numpy.float32)
+        corrected_images *= parameters[:,3].reshape(-1,1,1,1).astype(numpy.float32)
+    with cyberset_metrics.timer('augmentation_correction'):
+        corrected_images += warped_images
+        corrected_images += parameters[:,9:12].reshape(-1,1,1,3).astype(numpy.float32)
+        corrected_images *= parameters[:,0].reshape(-1,1,1,1).astype(numpy.float32)
+        corrected_images += parameters[:,1].reshape(-1,1,1,1).astype(numpy.float32)
+        numpy.clip(corrected_images, 0, 255, out=corrected_images)
+        result_images = corrected_images.astype(numpy.uint8)
+    with cyberset_metrics.timer('augmentation_blur'):
+        for k in range(count):
+            amount = parameters[k,2]
+            if amount >= 0:
+                size = int(2 * math.ceil(3 * amount) + 1)
+                cv2.GaussianBlur(result_images[k], (size,size), amount, dst=result_images[k])
+            else:
+                kernel = numpy.array([[0,0,0],[0,1,0],[0,0,0]], dtype=numpy.float32) + numpy.array([[0,-1,0],[-1,4,-1],[0,-1,0]], dtype=numpy.float32) * -amount
+                result_images[k] = cv2.filter2D(result_images[k], -1, kernel)
+    cyberset_metrics.count('augmented_images', count)
+    return result_images, parameters
+
+def benchmark_augmentation(target_size=224, count=240, seed=0):
+    rng = numpy.random.default_rng(seed)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (target_size, target_size, 3), dtype=numpy.uint8), (9,9), 3)
+    start = time.time()
+    for i in range(count):
+        generate_augmentation(image, rng=rng)
+    single_rate = count / (time.time() - start)
+    images = numpy.repeat(image[numpy.newaxis], count, axis=0)
+    start = time.time()
+    augment_batch(images, rng=rng)
+    batch_rate = count / (time.time() - start)
+    print('BENCHMARK size={} count={} single={:.1f} img/s batch={:.1f} img/s speedup={:.2f}x'.format(target_size, count, single_rate, batch_rate, batch_rate / single_rate))
+
 def determine_split(samples_count, train_split, validation_split, test_split):
     train_size = round(samples_count * train_split / 100)
     validation_size = round(samples_count * validation_split / 100)
@@ -102,70 +209,299 @@ def determine_split(samples_count, train_split, validation_split, test_split):
     train_size += samples_count - train_size - validation_size - test_size
     return train_size, validation_size, test_size
 
-def save_class_tf(label, samples, destination_directory, target_size, augmentation=0):
-    destination_book_path = '{}/images'.format(destination_directory)
-    if not os.path.exists(destination_book_path):
-        os.makedirs(destination_book_path)
-    augmented_samples = samples * math.ceil(augmentation / len(samples)) if augmentation > len(samples) else samples
-    base_number = len(os.listdir(destination_book_path))
+def split_samples(samples, train_split, validation_split, test_split, generator, groups=None):
+    units = sorted([sorted(x) for x in groups]) if groups is not None else [[x] for x in sorted(samples)]
+    train_size, validation_size, test_size = determine_split(len(units), train_split, validation_split, test_split)
+    generator.shuffle(units)
+    train_set = [x for unit in units[0:train_size] for x in unit]
+    validation_set = [x for unit in units[train_size:train_size+validation_size] for x in unit]
+    test_set = [x for unit in units[train_size+validation_size:train_size+validation_size+test_size] for x in unit]
+    return train_set, validation_set, test_set
+
+def duplicate_groups(directory, names, distance):
+    hashes = [cyberset_duplicates.dhash('{}/{}'.format(directory, x)) for x in names]
+    return [[names[k] for k in g] for g in cyberset_duplicates.group_near_duplicates(hashes, distance)]
+
+def task_seed(seed, label, split):
+    return [seed, zlib.crc32('{}/{}'.format(label, split).encode('utf-8'))]
+
+def output_count(augmentation, samples_count):
+    return max(augmentation, samples_count) if samples_count > 0 else 0
+
+def append_labels(label, count, destination_directory):
     with open('{}/labels.txt'.format(destination_directory), 'a') as labels_file:
-        for i in range(0, max(augmentation, len(samples))):
-            picture_in = cv2.cvtColor(cv2.imread(augmented_samples[i]), cv2.COLOR_BGR2RGB)
-            reshaped_picture = pad_scale(picture_in, target_size, PADDING_VALUE)
-            if i < len(samples):
-                picture_out = reshaped_picture
-            else:
-                picture_out = generate_augmentation(reshaped_picture)
-            cv2.imwrite('{}/{}.jpg'.format(destination_book_path, str(base_number + i)), cv2.cvtColor(picture_out, cv2.COLOR_RGB2BGR))
+        for i in range(count):
             labels_file.write('{}\n'.format(label))
 
-def save_class_pt(label, samples, destination_directory, target_size, augmentation=0):
+def save_class_tf(label, samples, destination_directory, target_size, augmentation=0, seed=None, base_number=None, cache_directory=None):
+    destination_book_path = '{}/images'.format(destination_directory)
+    os.makedirs(destination_book_path, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    pictures = [load_picture(x, target_size, cache_directory) for x in samples]
+    numbered = base_number is not None
+    base_number = base_number if numbered else len(os.listdir(destination_book_path))
+    count = output_count(augmentation, len(samples))
+    augmented_pictures, _ = augment_batch(numpy.stack(pictures)[numpy.arange(len(samples), count) % len(samples)], rng=rng) if count > 0 else ([], None)
+    outputs = list()
+    for i in range(0, count):
+        picture_out = pictures[i] if i < len(samples) else augmented_pictures[i - len(samples)]
+        outputs.append('{}/{}.jpg'.format(destination_book_path, str(base_number + i)))
+        with cyberset_metrics.timer('imwrite'):
+            cv2.imwrite(outputs[-1], cv2.cvtColor(picture_out, cv2.COLOR_RGB2BGR))
+    if not numbered:
+        append_labels(label, count, destination_directory)
+    return outputs
+
+def save_class_pt(label, samples, destination_directory, target_size, augmentation=0, seed=None, base_number=None, cache_directory=None):
     destination_book_path = '{}/{}'.format(destination_directory, label)
-    if not os.path.exists(destination_book_path):
-        os.makedirs(destination_book_path)
-    augmented_samples = samples * math.ceil(augmentation / len(samples)) if augmentation > len(samples) else samples
-    for i in range(0, max(augmentation, len(samples))):
-        picture_in = cv2.cvtColor(cv2.imread(augmented_samples[i]), cv2.COLOR_BGR2RGB)
-        reshaped_picture = pad_scale(picture_in, target_size, PADDING_VALUE)
-        if i < len(samples):
-            picture_out = reshaped_picture
-        else:
-            picture_out = generate_augmentation(reshaped_picture)
-        cv2.imwrite('{}/{}.jpg'.format(destination_book_path, str(i)), cv2.cvtColor(picture_out, cv2.COLOR_RGB2BGR))
+    os.makedirs(destination_book_path, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    pictures = [load_picture(x, target_size, cache_directory) for x in samples]
+    count = output_count(augmentation, len(samples))
+    augmented_pictures, _ = augment_batch(numpy.stack(pictures)[numpy.arange(len(samples), count) % len(samples)], rng=rng) if count > 0 else ([], None)
+    outputs = list()
+    for i in range(0, count):
+        picture_out = pictures[i] if i < len(samples) else augmented_pictures[i - len(samples)]
+        outputs.append('{}/{}.jpg'.format(destination_book_path, str(i)))
+        with cyberset_metrics.timer('imwrite'):
+            cv2.imwrite(outputs[-1], cv2.cvtColor(picture_out, cv2.COLOR_RGB2BGR))
+    return outputs
+
+def save_class_shards(label, samples, destination_directory, target_size, augmentation=0, seed=None, base_number=None, cache_directory=None):
+    destination_book_path = '{}/shards'.format(destination_directory)
+    os.makedirs(destination_book_path, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    pictures = [load_picture(x, target_size, cache_directory) for x in samples]
+    count = output_count(augmentation, len(samples))
+    augmented_pictures, _ = augment_batch(numpy.stack(pictures)[numpy.arange(len(samples), count) % len(samples)], rng=rng) if count > 0 else ([], None)
+    shard_path = '{}/{}.npy'.format(destination_book_path, label)
+    temporary_path = '{}.{}.tmp'.format(shard_path, os.getpid())
+    with cyberset_metrics.timer('shard_write'):
+        shard = numpy.lib.format.open_memmap(temporary_path, mode='w+', dtype=numpy.uint8, shape=(count, target_size, target_size, 3))
+        if count > 0:
+            shard[0:len(samples)] = numpy.stack(pictures)
+            shard[len(samples):count] = augmented_pictures
+        shard.flush()
+        del shard
+    os.replace(temporary_path, shard_path)
+    return [shard_path]
+
+class ShardReader:
+    def __init__(self, directory):
+        self.directory = '{}/shards'.format(directory)
+        self.classes = sorted([x[:-4] for x in os.listdir(self.directory) if x.endswith('.npy')])
+        self.shards = [numpy.load('{}/{}.npy'.format(self.directory, x), mmap_mode='r') for x in self.classes]
+        sizes = numpy.array([x.shape[0] for x in self.shards], dtype=numpy.int64)
+        self.offsets = numpy.concatenate([numpy.zeros(1, dtype=numpy.int64), numpy.cumsum(sizes)])
+        self.labels = numpy.repeat(numpy.arange(len(self.classes)), sizes)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def locate(self, indices):
+        shards = numpy.searchsorted(self.offsets, indices, side='right') - 1
+        return shards, indices - self.offsets[shards]
+
+    def __getitem__(self, index):
+        shard, offset = self.locate(index)
+        return self.shards[shard][offset], int(self.labels[index])
+
+    def slice(self, start, stop):
+        shard, offset = self.locate(start)
+        if stop <= self.offsets[shard+1]:
+            return self.shards[shard][offset:offset+stop-start], self.labels[start:stop]
+        return self.batch(numpy.arange(start, stop))
+
+    def batch(self, indices):
+        indices = numpy.asarray(indices)
+        shards, offsets = self.locate(indices)
+        images = numpy.empty((len(indices),) + self.shards[0].shape[1:], dtype=numpy.uint8)
+        for s in numpy.unique(shards):
+            mask = shards == s
+            images[mask] = self.shards[s][offsets[mask]]
+        return images, self.labels[indices]
+
+def hash_sample(path, previous=None):
+    stat = os.stat(path)
+    if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+        return previous
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return [stat.st_size, stat.st_mtime_ns, digest]
 
-def generate_dataset(source_directory, destination_directory, class_saver, target_size, train_split, validation_split, test_split, train_augmentation):
-    train_directory = '{}/{}'.format(destination_directory, 'train')
-    validation_directory = '{}/{}'.format(destination_directory, 'validation')
-    test_directory = '{}/{}'.format(destination_directory, 'test')
+def assign_splits(names, previous_splits, groups=None):
+    split_names = [[x for x in previous_splits[split] if x in names] for split in SPLITS]
+    assigned = dict((x, j) for j in range(len(SPLITS)) for x in split_names[j])
+    partners = dict((x, g) for g in groups for x in g) if groups is not None else dict()
+    for name in names:
+        if name not in assigned:
+            grouped = [assigned[x] for x in partners.get(name, []) if x in assigned]
+            empty = [j for j in range(1, len(SPLITS)) if len(split_names[j]) == 0]
+            assigned[name] = grouped[0] if len(grouped) > 0 else empty[0] if len(empty) > 0 else 0
+            split_names[assigned[name]].append(name)
+    units = [sorted(g) for g in groups] if groups is not None else [[x] for x in names]
+    for j in range(len(SPLITS)):
+        if len(split_names[j]) == 0:
+            donor = max(range(len(SPLITS)), key=lambda x: len(split_names[x]))
+            movable = sorted([g for g in units if all(x in split_names[donor] for x in g) and len(g) < len(split_names[donor])], key=lambda g: (len(g), g))
+            if len(movable) > 0:
+                split_names[donor] = [x for x in split_names[donor] if x not in movable[0]]
+                split_names[j] = list(movable[0])
+    return split_names
+
+def task_fingerprint(class_saver, target_size, augmentation, seed, hashes, base_number):
+    description = [class_saver.__name__, target_size, augmentation, seed, hashes, base_number]
+    return hashlib.sha1(json.dumps(description).encode('utf-8')).hexdigest()
+
+def remove_outputs(destination_directory, outputs):
+    for o in outputs:
+        path = '{}/{}'.format(destination_directory, o)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+def generate_dataset(source_directory, destination_directory, class_saver, target_size, train_split, validation_split, test_split, train_augmentation, workers=1, seed=None, cache_directory=None, incremental=False, duplicate_distance=None,
+                     metrics_file=None, profile=None):
+    cyberset_metrics.reset()
+    profiler = cyberset_metrics.start_profile(profile)
+    split_directories = ['{}/{}'.format(destination_directory, x) for x in SPLITS]
+    split_augmentations = (train_augmentation, 0, 0)
+    manifest_path = '{}/manifest.json'.format(destination_directory)
+    manifest = {'seed': None, 'sources': dict(), 'classes': dict()}
+    stale_outputs = list()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            existing = json.load(manifest_file)
+        if incremental:
+            manifest = existing
+        else:
+            stale_outputs += [x for previous in existing['classes'].values() for task in previous['tasks'].values() for x in task['outputs'] or []]
+    elif os.path.exists(destination_directory) and len(os.listdir(destination_directory)) > 0:
+        raise FileExistsError('{} is not empty and has no manifest.json'.format(destination_directory))
+    seed = manifest['seed'] if seed is None else seed
+    splits = [train_split, validation_split, test_split]
+    resplit = len(manifest['classes']) > 0 and manifest.get('splits') != splits
+    if resplit:
+        print('RESPLIT {} {} -> {}'.format(destination_directory, manifest.get('splits'), splits))
+    seed = random.randrange(2**32) if seed is None else seed
+    numbered = class_saver is save_class_tf
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
+    for d in split_directories:
+        os.makedirs(d, exist_ok=True)
+        if numbered:
+            open('{}/labels.txt'.format(d), 'w').close()
+    books = sorted(os.listdir(source_directory))
+    base_numbers = [0 for x in SPLITS]
+    sources = dict()
+    classes = dict()
+    tasks = list()
+    rebuilds = list()
+    for book in books:
+        source_book_path = '{}/{}'.format(source_directory, book)
+        names = sorted([x for x in os.listdir(source_book_path) if x != 'card.txt'])
+        for x in names:
+            key = '{}/{}'.format(book, x)
+            with cyberset_metrics.timer('hash_sample'):
+                sources[key] = hash_sample('{}/{}'.format(source_book_path, x), manifest['sources'].get(key))
+        previous = manifest['classes'].get(book)
+        with cyberset_metrics.timer('duplicate_groups'):
+            groups = duplicate_groups(source_book_path, names, duplicate_distance) if duplicate_distance is not None else None
+        if previous is None or resplit:
+            split_sets = split_samples(names, train_split, validation_split, test_split, random.Random('{}/{}'.format(seed, book)), groups)
+        else:
+            split_sets = assign_splits(names, previous['splits'], groups)
+        label = book[4:]
+        classes[book] = {'splits': dict(zip(SPLITS, split_sets)), 'tasks': dict()}
+        for j, split in enumerate(SPLITS):
+            samples = ['{}/{}'.format(source_book_path, x) for x in split_sets[j]]
+            hashes = [sources['{}/{}'.format(book, x)][2] for x in split_sets[j]]
+            task = (label, samples, split_directories[j], target_size, split_augmentations[j], task_seed(seed, label, split), base_numbers[j], cache_directory)
+            fingerprint = task_fingerprint(class_saver, target_size, split_augmentations[j], task[5], hashes, base_numbers[j] if numbered else None)
+            previous_task = previous['tasks'][split] if previous is not None else None
+            if previous_task is not None and previous_task['fingerprint'] == fingerprint:
+                classes[book]['tasks'][split] = previous_task
+            else:
+                classes[book]['tasks'][split] = {'fingerprint': fingerprint, 'outputs': None}
+                rebuilds.append(task)
+                stale_outputs += previous_task['outputs'] if previous_task is not None else []
+            tasks.append(task)
+            base_numbers[j] += output_count(split_augmentations[j], len(split_sets[j]))
+    for book, previous in manifest['classes'].items():
+        if book not in classes:
+            stale_outputs += [x for task in previous['tasks'].values() for x in task['outputs']]
+    remove_outputs(destination_directory, stale_outputs)
+    print('GENERATING {} books={} rebuilds={} workers={} seed={}'.format(destination_directory, len(books), len(rebuilds), workers, seed))
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=cv2.setNumThreads, initargs=(1,))
+        results = executor.map(cyberset_metrics.collect, [class_saver for x in rebuilds], *zip(*rebuilds)) if len(rebuilds) > 0 else iter([])
+    else:
+        executor = None
+        results = ((class_saver(*x), None) for x in rebuilds)
     with open('{}/classes.txt'.format(destination_directory), 'w') as classes_file:
-        for i, book in enumerate(os.listdir(source_directory)):
-            source_book_path = '{}/{}'.format(source_directory, book)
-            samples = ['{}/{}'.format(source_book_path, x) for x in os.listdir(source_book_path) if x != 'card.txt']
-            train_size, validation_size, test_size = determine_split(len(samples), train_split, validation_split, test_split)
-            random.shuffle(samples)
-            train_set = samples[0:train_size]
-            validation_set = samples[train_size:train_size+validation_size]
-            test_set = samples[train_size+validation_size:train_size+validation_size+test_size]
-            label = book[4:]
-            class_saver(label, train_set, train_directory, target_size, train_augmentation)
-            class_saver(label, validation_set, validation_directory, target_size, 0)
-            class_saver(label, test_set, test_directory, target_size, 0)
-            with open('{}/card.txt'.format(source_book_path), 'r') as card_file:
+        for i, book in enumerate(books):
+            sizes = list()
+            for j, split in enumerate(SPLITS):
+                label, split_set, split_directory, _, augmentation, _, _, _ = tasks[i*len(SPLITS)+j]
+                if classes[book]['tasks'][split]['outputs'] is None:
+                    outputs, metrics = next(results)
+                    if metrics is not None:
+                        cyberset_metrics.merge(metrics)
+                    classes[book]['tasks'][split]['outputs'] = [os.path.relpath(x, destination_directory) for x in outputs]
+                if numbered:
+                    append_labels(label, output_count(augmentation, len(split_set)), split_directory)
+                sizes.append(len(split_set))
+            with open('{}/{}/card.txt'.format(source_directory, book), 'r') as card_file:
                 data = card_file.read().splitlines()
             classes_file.write('{}\t{}\t{}\n'.format(data[2], data[0], data[1]))
-            print('BOOK {}/{} lab={} tra={} val={} tes={}'.format(i+1, len(os.listdir(source_directory)), label, train_size, validation_size, test_size))
+            print('BOOK {}/{} lab={} tra={} val={} tes={}'.format(i+1, len(books), label, *sizes))
+    if executor is not None:
+        executor.shutdown()
+    with open('{}.tmp'.format(manifest_path), 'w') as manifest_file:
+        json.dump({'seed': seed, 'splits': splits, 'sources': sources, 'classes': classes}, manifest_file)
+    os.replace('{}.tmp'.format(manifest_path), manifest_path)
+    cyberset_metrics.report('GENERATING {}'.format(destination_directory), '{}/metrics.json'.format(destination_directory) if metrics_file is None else metrics_file, profiler)
+
+CLASS_SAVERS = {'tf': save_class_tf, 'pt': save_class_pt, 'shards': save_class_shards}
 
-# generate_dataset(SOURCE_DATASET, 'cyberset_tf_128', save_class_tf, target_size=128, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
-# shutil.make_archive('cyberset_tf_128', 'zip', '.', 'cyberset_tf_128')
-# generate_dataset(SOURCE_DATASET, 'cyberset_tf_56', save_class_tf, target_size=56, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
-# shutil.make_archive('cyberset_tf_56', 'zip', '.', 'cyberset_tf_56')
-# generate_dataset(SOURCE_DATASET, 'cyberset_tf_96', save_class_tf, target_size=96, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
-# shutil.make_archive('cyberset_tf_96', 'zip', '.', 'cyberset_tf_96')
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate the training datasets from the cleaned book pictures.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='split, augment and save a dataset')
+    generate.add_argument('destination')
+    generate.add_argument('--source', default=SOURCE_DATASET)
+    generate.add_argument('--saver', default='pt', choices=tuple(CLASS_SAVERS), help='tf numbered folders, pt class folders or binary shards')
+    generate.add_argument('--size', type=int, default=224, help='target picture size in pixels')
+    generate.add_argument('--split', type=int, nargs=3, default=(70, 20, 10), metavar=('TRAIN', 'VALIDATION', 'TEST'), help='split percentages')
+    generate.add_argument('--augmentation', type=int, default=60, help='augmented train pictures per class')
+    generate.add_argument('--workers', type=int, default=1)
+    generate.add_argument('--seed', type=int)
+    generate.add_argument('--cache-directory', help='decoded picture cache shared between sizes')
+    generate.add_argument('--incremental', action='store_true', help='only rebuild the classes whose sources changed')
+    generate.add_argument('--duplicate-distance', type=int, help='keep near-duplicate pictures in the same split')
+    generate.add_argument('--archive', action='store_true', help='zip the dataset when done')
+    generate.add_argument('--metrics', help='metrics report file (default: metrics.json in the destination)')
+    generate.add_argument('--profile', choices=('cprofile', 'sample'), help='profile the generation and add the hottest functions to the report')
+    benchmark = commands.add_parser('benchmark-augmentation', help='compare single and batched augmentation')
+    benchmark.add_argument('--size', type=int, default=224)
+    benchmark.add_argument('--count', type=int, default=240)
+    benchmark.add_argument('--seed', type=int, default=0)
+    return parser
 
-# generate_dataset(SOURCE_DATASET, 'fairset_good_227', save_class_pt, target_size=227, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
-# generate_dataset(SOURCE_DATASET, 'fairset_good_224', save_class_pt, target_size=224, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
-# generate_dataset(SOURCE_DATASET, 'fairset_good_299', save_class_pt, target_size=299, train_split=70, validation_split=20, test_split=10, train_augmentation=60)
+def main(argv=None):
+    arguments = build_parser().parse_args(argv)
+    if arguments.command == 'generate':
+        generate_dataset(arguments.source, arguments.destination, CLASS_SAVERS[arguments.saver], target_size=arguments.size, train_split=arguments.split[0],
+                         validation_split=arguments.split[1], test_split=arguments.split[2], train_augmentation=arguments.augmentation, workers=arguments.workers,
+                         seed=arguments.seed, cache_directory=arguments.cache_directory, incremental=arguments.incremental,
+                         duplicate_distance=arguments.duplicate_distance, metrics_file=arguments.metrics, profile=arguments.profile)
+        if arguments.archive:
+            shutil.make_archive(arguments.destination, 'zip', '.', arguments.destination)
+    elif arguments.command == 'benchmark-augmentation':
+        benchmark_augmentation(target_size=arguments.size, count=arguments.count, seed=arguments.seed)
 
-print('DONE')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import re
+import math
+import itertools
+import collections
+
+GRAM_SIZE = 3
+RECORD_SIMILARITY = 0.8
+SEPARATORS = ('\'', '-', '/', '\r', '\n', '\t')
+FOLDING = str.maketrans('', '', 'àèéìòù\ufffd')
+PARENTHESES = re.compile('\\([^\x00]*?\\)')
+INVALID = re.compile('[^a-zA-Z0-9àèéìòùÀÈÉÌÒÙ \x00]+')
+FOLDED_INVALID = re.compile('[^a-z0-9 \x00]+')
+SPACES = re.compile('  +')
+EDGES = re.compile(' \x00 ?|\x00 ')
+DIGITS = re.compile('[0-9]+')
+
+def clean_records(strings):
+    text = '\x00'.join(x.replace('\x00', '') for x in strings) if any('\x00' in x for x in strings) else '\x00'.join(strings)
+    for separator in SEPARATORS:
+        text = text.replace(separator, ' ')
+    text = PARENTHESES.sub('', text)
+    text = INVALID.sub('', text)
+    text = SPACES.sub(' ', text)
+    text = EDGES.sub('\x00', text).lower().strip(' ')
+    return text.split('\x00') if len(strings) > 0 else []
+
+def clean_record(string):
+    return clean_records([string])[0]
+
+def fold_records(strings):
+    text = '\x00'.join(clean_records(strings)).translate(FOLDING)
+    text = FOLDED_INVALID.sub('', text)
+    text = SPACES.sub(' ', text)
+    text = EDGES.sub('\x00', text).strip(' ')
+    return text.split('\x00') if len(strings) > 0 else []
+
+def record_grams(string, size=GRAM_SIZE):
+    padded = ' {} '.format(string)
+    grams = set(padded[i:i+size] for i in range(len(padded) - size + 1))
+    return grams if len(grams) > 0 else {padded}
+
+def similarity(first, second):
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+def similar_records(first, second, threshold=RECORD_SIMILARITY):
+    first_keys = fold_records(first)
+    second_keys = fold_records(second)
+    return all(similarity(record_grams(x), record_grams(y)) >= threshold for x, y in zip(first_keys, second_keys)) and DIGITS.findall(first_keys[0]) == DIGITS.findall(second_keys[0])
+
+def near_duplicate_records(titles, authors, threshold=RECORD_SIMILARITY):
+    title_keys = fold_records(titles)
+    author_keys = fold_records(authors)
+    title_grams = [record_grams(x) for x in title_keys]
+    author_grams = [record_grams(x) for x in author_keys]
+    numbers = [DIGITS.findall(x) for x in title_keys]
+    frequencies = collections.Counter(g for x in title_grams for g in x)
+    index = collections.defaultdict(list)
+    starts = collections.defaultdict(int)
+    pairs = list()
+    for i in sorted(range(len(title_grams)), key=lambda x: len(title_grams[x])):
+        grams = sorted(title_grams[i], key=lambda x: (frequencies[x], x))
+        size = len(grams)
+        overlaps = dict()
+        for position, g in enumerate(grams[0:size - math.ceil(threshold * size) + 1]):
+            postings = index[g]
+            while starts[g] < len(postings) and len(title_grams[postings[starts[g]][0]]) < threshold * size:
+                starts[g] += 1
+            for j, other_position in itertools.islice(postings, starts[g], None):
+                overlap = overlaps.get(j, 0)
+                if overlap < 0:
+                    continue
+                other_size = len(title_grams[j])
+                required = math.ceil(threshold / (1 + threshold) * (size + other_size) - 1e-9)
+                overlaps[j] = overlap + 1 if overlap + 1 + min(size - position, other_size - other_position) - 1 >= required else -1
+            postings.append((i, position))
+        for j, overlap in overlaps.items():
+            if overlap > 0 and numbers[i] == numbers[j] and similarity(title_grams[i], title_grams[j]) >= threshold and similarity(author_grams[i], author_grams[j]) >= threshold:
+                pairs.append((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+def union_groups(count, pairs):
+    parents = list(range(count))
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    for a, b in pairs:
+        parents[root(b)] = root(a)
+    groups = dict()
+    for i in range(count):
+        groups.setdefault(root(i), list()).append(i)
+    return list(groups.values())
+
+def group_near_records(titles, authors, threshold=RECORD_SIMILARITY):
+    return union_groups(len(titles), near_duplicate_records(titles, authors, threshold))
+
+def code_number(code):
+    digits = DIGITS.findall(code)
+    return int(digits[0]) if len(digits) > 0 else math.inf
+
+def canonical_record(titles, authors, codes=None):
+    # most frequent spelling first, then the one of the oldest catalog entry (lowest NILF code), whose card has been reviewed the longest
+    counts = collections.Counter(zip(titles, authors))
+    oldest = dict()
+    for key, code in zip(zip(titles, authors), codes if codes is not None else ['' for x in titles]):
+        oldest[key] = min(oldest.get(key, math.inf), code_number(code))
+    return min(counts, key=lambda x: (-counts[x], oldest[x], x))
@@ -0,0 +1,176 @@
+import random
+import time
+import os
+import queue as queues
+import weakref
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy
+import cv2
+import cyberset_preprocessor
+try:
+    import torch
+    IterableDataset = torch.utils.data.IterableDataset
+except ImportError:
+    torch = None
+    IterableDataset = object
+
+WORKERS = os.cpu_count()
+QUEUE_SIZE = 8
+QUEUE_TIMEOUT = 5.0
+CHUNK_SIZE = 32
+IMAGENET_MEAN = numpy.array([0.485, 0.456, 0.406], dtype=numpy.float32)
+IMAGENET_STD = numpy.array([0.229, 0.224, 0.225], dtype=numpy.float32)
+
+def load_sources(source_directory, target_size, train_split, validation_split, test_split, seed, cache_directory=None, duplicate_distance=None):
+    books = sorted(os.listdir(source_directory))
+    paths = list()
+    labels = list()
+    for i, book in enumerate(books):
+        source_book_path = '{}/{}'.format(source_directory, book)
+        names = [x for x in os.listdir(source_book_path) if x != 'card.txt']
+        groups = cyberset_preprocessor.duplicate_groups(source_book_path, names, duplicate_distance) if duplicate_distance is not None else None
+        train_set, _, _ = cyberset_preprocessor.split_samples(names, train_split, validation_split, test_split, random.Random('{}/{}'.format(seed, book)), groups)
+        paths += ['{}/{}'.format(source_book_path, x) for x in train_set]
+        labels += [i for x in train_set]
+    shape = (len(paths), target_size, target_size, 3)
+    memory = multiprocessing.shared_memory.SharedMemory(create=True, size=int(numpy.prod(shape)))
+    try:
+        pictures = numpy.ndarray(shape, dtype=numpy.uint8, buffer=memory.buf)
+        for k, path in enumerate(paths):
+            pictures[k] = cyberset_preprocessor.pad_scale(cyberset_preprocessor.decode_picture(path, cache_directory), target_size, cyberset_preprocessor.PADDING_VALUE)
+        del pictures
+    except BaseException:
+        release_sources(memory)
+        raise
+    return [x[4:] for x in books], numpy.array(labels), memory, shape
+
+def release_sources(memory):
+    memory.close()
+    try:
+        memory.unlink()
+    except FileNotFoundError:
+        pass
+
+def attach_sources(memory_name, shape):
+    memory = multiprocessing.shared_memory.SharedMemory(name=memory_name)
+    return memory, numpy.ndarray(shape, dtype=numpy.uint8, buffer=memory.buf)
+
+def augment_indices(pictures, labels, count, rng):
+    _, starts, sizes = numpy.unique(labels, return_index=True, return_counts=True)
+    drawn = rng.integers(0, len(starts), count)
+    indices = rng.integers(starts[drawn], starts[drawn] + sizes[drawn])
+    images, _ = cyberset_preprocessor.augment_batch(pictures[indices], rng=rng)
+    return images, labels[indices]
+
+def stream_worker(memory_name, shape, labels, batch_size, seed, queue):
+    cv2.setNumThreads(1)
+    memory, pictures = attach_sources(memory_name, shape)
+    rng = numpy.random.default_rng(seed)
+    while True:
+        queue.put(augment_indices(pictures, labels, batch_size, rng))
+
+def stream_batches(source_directory, target_size, batch_size, train_split=70, validation_split=20, test_split=10, seed=None, workers=WORKERS, queue_size=QUEUE_SIZE, batches=None, cache_directory=None, duplicate_distance=None):
+    seed = random.randrange(2**32) if seed is None else seed
+    classes, labels, memory, shape = load_sources(source_directory, target_size, train_split, validation_split, test_split, seed, cache_directory, duplicate_distance)
+    print('STREAMING {} classes={} sources={} workers={} seed={}'.format(source_directory, len(classes), len(labels), workers, seed))
+    queue = multiprocessing.Queue(queue_size)
+    processes = [multiprocessing.Process(target=stream_worker, args=(memory.name, shape, labels, batch_size, [seed, k], queue), daemon=True) for k in range(workers)]
+    pictures = numpy.ndarray(shape, dtype=numpy.uint8, buffer=memory.buf)
+    rng = numpy.random.default_rng([seed, workers])
+    try:
+        for p in processes:
+            p.start()
+        produced = 0
+        while batches is None or produced < batches:
+            batch = None
+            while workers > 0 and batch is None:
+                try:
+                    batch = queue.get(timeout=QUEUE_TIMEOUT)
+                except queues.Empty:
+                    if not all(p.is_alive() for p in processes):
+                        raise RuntimeError('stream workers exited with codes {}'.format([p.exitcode for p in processes]))
+            yield batch if workers > 0 else augment_indices(pictures, labels, batch_size, rng)
+            produced += 1
+    finally:
+        for p in processes:
+            p.terminate()
+            p.join()
+        del pictures
+        release_sources(memory)
+
+def normalize_image(image):
+    normalized_image = (image.astype(numpy.float32) / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+    return numpy.ascontiguousarray(normalized_image.transpose(2, 0, 1))
+
+class AugmentationDataset(IterableDataset):
+    def __init__(self, source_directory, target_size, train_split=70, validation_split=20, test_split=10, augmentation=60, seed=None, transform=normalize_image, cache_directory=None, duplicate_distance=None):
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self.classes, self.labels, self.memory, self.shape = load_sources(source_directory, target_size, train_split, validation_split, test_split, self.seed, cache_directory, duplicate_distance)
+        self.memory_name = self.memory.name
+        self.finalizer = weakref.finalize(self, release_sources, self.memory)
+        self.epoch_size = len(numpy.unique(self.labels)) * augmentation
+        self.transform = transform
+        self.epoch = 0
+
+    def __len__(self):
+        return self.epoch_size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = None
+        state['finalizer'] = None
+        return state
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info() if torch is not None else None
+        if info is None:
+            rng = numpy.random.default_rng([self.seed, self.epoch])
+            count = self.epoch_size
+            self.epoch += 1
+        else:
+            rng = numpy.random.default_rng([self.seed, info.seed % 2**32])
+            count = self.epoch_size // info.num_workers + (1 if info.id < self.epoch_size % info.num_workers else 0)
+        if self.memory is None:
+            self.memory, _ = attach_sources(self.memory_name, self.shape)
+        pictures = numpy.ndarray(self.shape, dtype=numpy.uint8, buffer=self.memory.buf)
+        for start in range(0, count, CHUNK_SIZE):
+            images, labels = augment_indices(pictures, self.labels, min(CHUNK_SIZE, count - start), rng)
+            for image, label in zip(images, labels):
+                image = self.transform(image) if self.transform is not None else image
+                yield (torch.from_numpy(image) if torch is not None else image), int(label)
+
+    def close(self):
+        if self.finalizer is not None:
+            self.finalizer()
+        elif self.memory is not None:
+            self.memory.close()
+        self.memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def benchmark_stream(source_directory, target_size=224, batch_size=32, step_time=0.05, batches=200, workers=WORKERS):
+    start = time.time()
+    stream = stream_batches(source_directory, target_size, batch_size, seed=0, workers=workers, batches=batches)
+    next(stream)
+    ready = time.time()
+    waiting = 0.0
+    for i in range(batches - 1):
+        time.sleep(step_time)
+        before = time.time()
+        images, labels = next(stream)
+        waiting += time.time() - before
+    elapsed = time.time() - ready
+    stream.close()
+    print('BENCHMARK size={} batch={} workers={} setup={:.2f}s rate={:.1f} samples/s waiting={:.1f}% of {:.3f}s steps'.format(
+        target_size, batch_size, workers, ready - start, (batches - 1) * batch_size / elapsed, waiting / elapsed * 100, step_time))
+
+# for images, labels in stream_batches('nilfdb', target_size=224, batch_size=32, seed=1234, batches=1000):
+#     pass
+# dataset = AugmentationDataset('nilfdb', target_size=224, seed=1234)
+# dataloader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=2)
+# benchmark_stream('nilfdb', target_size=224, batch_size=32, step_time=0.05)